@@ -10,10 +10,13 @@ The knack CLI framework does not expect the JSON structures returned by `kubectl
 transformations expose useful fields for the table and tab-separated output formats.
 """
 
-import json
-
 import jmespath
 
+try:
+    from orjson import loads as json_loads  # pylint: disable=no-name-in-module
+except ImportError:
+    from json import loads as json_loads
+
 
 CLUSTER_TABLE_FORMAT = """\
 {
@@ -29,9 +32,9 @@ CLUSTERS_LIST_TABLE_FORMAT = f"items[].{CLUSTER_TABLE_FORMAT}"
 
 def output_for_tsv(json_string):
     """Return JSON data to output a cluster in tab-separated format."""
-    return jmespath.search(CLUSTER_TABLE_FORMAT, json.loads(json_string))
+    return jmespath.search(CLUSTER_TABLE_FORMAT, json_loads(json_string))
 
 
 def output_list_for_tsv(json_string):
     """Return JSON data to output a list of clusters in tab-separated format."""
-    return jmespath.search(CLUSTERS_LIST_TABLE_FORMAT, json.loads(json_string))
+    return jmespath.search(CLUSTERS_LIST_TABLE_FORMAT, json_loads(json_string))
@@ -28,9 +28,11 @@ parameters:
   - name: --control-plane-machine-count -u
     type: integer
     short-summary: Number of control plane machines
+    long-summary: If not specified, CONTROL_PLANE_MACHINE_COUNT or 3 will be used (in this order).
   - name: --control-plane-machine-type -z
     type: string
     short-summary: Type of control plane machine
+    long-summary: If not specified, AZURE_CONTROL_PLANE_MACHINE_TYPE or Standard_B2s will be used (in this order).
   - name: --ephemeral-disks -e
     type: string
     short-summary: Use ephemeral disks
@@ -69,6 +71,7 @@ parameters:
   - name: --kubernetes-version -k
     type: string
     short-summary: Version of Kubernetes to use
+    long-summary: If not specified, KUBERNETES_VERSION or v1.25.3 will be used (in this order).
     populator-commands:
       - "`az vm image list -p cncf-upstream -f capi --all`"
   - name: --location -l
@@ -89,9 +92,11 @@ parameters:
   - name: --node-machine-count
     type: integer
     short-summary: Number of node machines
+    long-summary: If not specified, WORKER_MACHINE_COUNT or 3 will be used (in this order).
   - name: --node-machine-type
     type: string
     short-summary: Type of node machine
+    long-summary: If not specified, AZURE_NODE_MACHINE_TYPE or Standard_B2s will be used (in this order).
   - name: --name -n
     type: string
     long-summary: If not specified, a random name will be generated.
@@ -107,6 +112,7 @@ parameters:
   - name: --ssh-public-key
     type: string
     short-summary: Public key contents to install on node VMs for SSH access.
+    long-summary: If not specified, AZURE_SSH_PUBLIC_KEY will be used.
   - name: --tags -t
     type: string
     short-summary: Tags applied to the management cluster and resource group if using AKS
@@ -131,6 +137,8 @@ type: command
 short-summary: Delete a workload cluster.
 long-summary: |
     See https://capz.sigs.k8s.io/ for more information.
+    With --no-wait, the command returns once the delete has been requested and Azure resources
+    are cleaned up in the background.
 """
 
 helps['capi install'] = """
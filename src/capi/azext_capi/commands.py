@@ -18,7 +18,7 @@ def load_command_table(self, _):
     with self.command_group('capi', is_preview=True) as g:
         g.custom_command('create', 'create_workload_cluster',
                          table_transformer=CLUSTER_TABLE_FORMAT)
-        g.custom_command('delete', 'delete_workload_cluster')
+        g.custom_command('delete', 'delete_workload_cluster', supports_no_wait=True)
         g.custom_command('list', 'list_workload_clusters',
                          table_transformer=CLUSTERS_LIST_TABLE_FORMAT)
         g.custom_show_command('show', 'show_workload_cluster',
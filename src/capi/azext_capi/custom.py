@@ -11,6 +11,9 @@
 # pylint: disable=too-many-arguments
 
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from urllib.parse import urlparse
 import base64
 import ipaddress
 import json
@@ -18,10 +21,8 @@ import os
 import re
 import subprocess
 import time
-import yaml
 
 import azext_capi.helpers.kubectl as kubectl_helpers
-import semver
 
 from azure.cli.core import get_default_cli
 from azure.cli.core.api import get_config_dir
@@ -29,24 +30,23 @@ from azure.cli.core.azclierror import InvalidArgumentValueError
 from azure.cli.core.azclierror import RequiredArgumentMissingError
 from azure.cli.core.azclierror import ResourceNotFoundError
 from azure.cli.core.azclierror import UnclassifiedUserFault
-from azure.core.exceptions import ResourceNotFoundError as ResourceNotFoundException
-from jinja2 import Environment, PackageLoader, StrictUndefined
-from jinja2.exceptions import UndefinedError
 from knack.prompting import prompt_choice_list, prompt_y_n
-from msrestazure.azure_exceptions import CloudError
 
-from ._format import output_for_tsv, output_list_for_tsv
-from .helpers.binary import check_clusterctl, check_helm, check_kubectl, check_kind
-from .helpers.constants import MANAGEMENT_RG_NAME, AKS_INFRA_RG_NAME, AKS_VNET_NAME, CAPZ_BASE_CONTENT_URL, DEFAULT_CALICO_VERSION
-from .helpers.generic import has_kind_prefix, match_output, is_clusterctl_compatible
-from .helpers.kubectl import create_configmap, get_configmap
+from ._format import json_loads, output_for_tsv, output_list_for_tsv
+from .helpers.binary import check_binaries, check_kind, install_clusterctl, install_helm, install_kubectl
+from .helpers.constants import MANAGEMENT_RG_NAME, AKS_INFRA_RG_NAME, AKS_VNET_NAME, CAPZ_BASE_CONTENT_URL, DEFAULT_CALICO_VERSION, KUBECONFIG
+from .helpers.constants import WORKLOAD_CLUSTER_REQUIRED_ENV
+from .helpers.generic import has_kind_prefix, strip_kind_prefix, workload_cluster_default
+from .helpers.kubectl import create_configmap, get_configmap, run_kubectl_apply
 from .helpers.logger import logger
 from .helpers.names import generate_cluster_name
-from .helpers.network import urlretrieve
 from .helpers.os import prep_kube_config, set_environment_variables, write_to_file
 from .helpers.prompt import get_cluster_name_by_user_prompt, get_user_prompt_or_default
-from .helpers.run_command import message_variants, retry_shell_command, run_shell_command, try_command_with_spinner
+from .helpers.resource_group import delete_resource_group
+from .helpers.run_command import backoff_delay, iter_shell_command_lines, message_variants, retry_shell_command
+from .helpers.run_command import retry_with_backoff, run_shell_command, try_command_with_spinner
 from .helpers.spinner import Spinner
+from .helpers.template import render_builtin_jinja_template, render_custom_cluster_template, render_windows_proxy_manifests
 
 
 def init_environment(cmd, prompt=True, management_cluster_name=None,
@@ -174,21 +174,28 @@ def create_aks_management_cluster(cmd, cluster_name, resource_group_name=None, l
                "--network-plugin", "azure", "--network-policy", "calico", "--node-count", "1", "--tags", tags]
     try_command_with_spinner(cmd, command, "Create Azure management cluster with AKS")
     os.environ[MANAGEMENT_RG_NAME] = resource_group_name
-    aks_infra_rg_name = find_resource_group_name_of_aks_infrastructure(resource_group_name, cluster_name)
-    os.environ[AKS_INFRA_RG_NAME] = aks_infra_rg_name
-    os.environ[AKS_VNET_NAME] = find_aks_vnet_name(aks_infra_rg_name)
     logger.warning("aks credentials will overwrite existing cluster config for cluster %s if it exists", cluster_name)
     prep_kube_config()
-    with Spinner(cmd, "Obtaining AKS credentials", "✓ Obtained AKS credentials"):
-        command = ["az", "aks", "get-credentials", "-g", resource_group_name, "--name", cluster_name,
-                   "--overwrite-existing"]
-        try:
-            subprocess.check_call(command, universal_newlines=True)
-        except subprocess.CalledProcessError as err:
-            raise UnclassifiedUserFault("Couldn't get credentials for AKS management cluster") from err
+    # The network lookups don't depend on the credentials, so run both az calls at once.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        network_names = executor.submit(find_aks_network_names, resource_group_name, cluster_name)
+        with Spinner(cmd, "Obtaining AKS credentials", "✓ Obtained AKS credentials"):
+            command = ["az", "aks", "get-credentials", "-g", resource_group_name, "--name", cluster_name,
+                       "--overwrite-existing"]
+            try:
+                run_shell_command(command)
+            except subprocess.CalledProcessError as err:
+                raise UnclassifiedUserFault("Couldn't get credentials for AKS management cluster") from err
+        os.environ[AKS_INFRA_RG_NAME], os.environ[AKS_VNET_NAME] = network_names.result()
     return True
 
 
+def find_aks_network_names(resource_group_name, cluster_name):
+    """Return the AKS infrastructure resource group and the name of the vnet in it."""
+    aks_infra_rg_name = find_resource_group_name_of_aks_infrastructure(resource_group_name, cluster_name)
+    return aks_infra_rg_name, find_aks_vnet_name(aks_infra_rg_name)
+
+
 def create_new_management_cluster(cmd, cluster_name=None, resource_group_name=None,
                                   location=None, pre_prompt_text=None, prompt=True, tags=""):
     choices = ["azure - a management cluster in the Azure cloud",
@@ -221,11 +228,12 @@ Where do you want to create a management cluster?
 
 
 def find_resource_group_name_of_aks_cluster(cluster_name):
-    jmespath_query = "[].{name:name, group:resourceGroup}"
-    command = ["az", "aks", "list", "--query", jmespath_query]
-    output = json.loads(run_shell_command(command))
-    result = [item for item in output if item['name'] == cluster_name]
-    return result[0]["group"] if result else None
+    # Filter in the query so only the matching resource group is returned, quoting the name as a JSON literal.
+    jmespath_query = f"[?name==`{json.dumps(cluster_name)}`].resourceGroup | [0]"
+    command = ["az", "aks", "list", "--query", jmespath_query, "--output", "json"]
+    output = run_shell_command(command).strip()
+    # az prints nothing when the query result is null
+    return json.loads(output) if output else None
 
 
 def delete_management_cluster(cmd, yes=False):  # pylint: disable=unused-argument
@@ -267,12 +275,11 @@ def show_management_cluster(cmd, yes=False):  # pylint: disable=unused-argument
         raise InvalidArgumentValueError("no kubeconfig")
     # make a $HOME/.azure/capi directory for storing cluster configurations
     path = os.path.join(get_config_dir(), "capi")
-    if not os.path.exists(path):
-        os.makedirs(path)
+    os.makedirs(path, exist_ok=True)
     command = ["kubectl", "config", "get-contexts", "--no-headers", "--output", "name"]
     try:
-        output = run_shell_command(command)
-        logger.info(output.splitlines())
+        for context in iter_shell_command_lines(command):
+            logger.info(context)
     except subprocess.CalledProcessError as err:
         raise UnclassifiedUserFault from err
     if not yes and prompt_y_n(path + "ok", default="n"):
@@ -310,7 +317,7 @@ def generate_workload_cluster_configuration(cmd, filename, args, user_provided_t
         manifest = None
         try:
             if user_provided_template:
-                manifest = render_custom_cluster_template(user_provided_template, filename, args)
+                manifest = render_custom_cluster_template(user_provided_template, args)
             else:
                 manifest = render_builtin_jinja_template(args)
             write_to_file(filename, manifest)
@@ -319,41 +326,6 @@ def generate_workload_cluster_configuration(cmd, filename, args, user_provided_t
             raise UnclassifiedUserFault(msg) from err
 
 
-def render_builtin_jinja_template(args):
-    """Use the built-in template and process it with Jinja."""
-    env = Environment(loader=PackageLoader("azext_capi", "templates"),
-                      auto_reload=False, undefined=StrictUndefined)
-    logger.debug("Available templates: %s", env.list_templates())
-    jinja_template = env.get_template("base.jinja")
-    try:
-        return jinja_template.render(args)
-    except UndefinedError as err:
-        msg = f"Could not generate workload cluster configuration.\n{err}"
-        raise RequiredArgumentMissingError(msg) from err
-
-
-def render_custom_cluster_template(template, filename, args=None):
-    """Fetch a user-defined template and process it with "clusterctl generate"."""
-    set_environment_variables(args)
-    command = ["clusterctl", "generate", "yaml", "--from"]
-    if not is_clusterctl_compatible(template):
-        # download file so clusterctl can use a local file
-        file_name = f"raw-{filename}"
-        urlretrieve(template, file_name)
-        template = file_name
-    command += [template]
-    try:
-        return run_shell_command(command)
-    except subprocess.CalledProcessError as err:
-        err_command_list = err.args[1]
-        err_command_name = err_command_list[0]
-        if err_command_name == "clusterctl":
-            error_variables = re.search(r"(?<=\[).+?(?=\])", err.stdout)[0]
-            msg = "Could not generate workload cluster configuration."
-            msg += f"\nPlease set the following environment variables:\n{error_variables}"
-        raise RequiredArgumentMissingError(msg) from err
-
-
 def get_default_bootstrap_commands(windows=False):
     '''Returns a dictionary with default pre- and post-bootstrap VM commands.'''
     post_bootstrap_cmds = ["nssm set kubelet start SERVICE_AUTO_START",
@@ -366,16 +338,23 @@ def parse_bootstrap_commands_from_file(file_path):
     pre_commands, post_commands = [], []
     if not os.path.isfile(file_path):
         raise InvalidArgumentValueError("Invalid boostrap command file")
-    file_result = None
-    with open(file_path, "r", encoding="utf-8") as file:
-        file_result = yaml.safe_load(file)
-    for key, value in file_result.items():
-        if not value:
-            continue
-        if key == "preBootstrapCommands":
-            pre_commands = [value] if isinstance(value, str) else value
-        elif key == "postBootstrapCommands":
-            post_commands = [value] if isinstance(value, str) else value
+    with open(file_path, "rb") as file:
+        data = file.read()
+    if not data:
+        return {"pre": pre_commands, "post": post_commands}
+    import yaml  # pylint: disable=import-outside-toplevel
+    # Prefer the libyaml-backed loader when PyYAML was built with it.
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    file_result = yaml.load(data, Loader=loader) or {}
+    unknown_keys = file_result.keys() - {"preBootstrapCommands", "postBootstrapCommands"}
+    if unknown_keys:
+        logger.warning("Ignoring unknown keys in %s: %s", file_path, ", ".join(sorted(unknown_keys)))
+    value = file_result.get("preBootstrapCommands")
+    if value:
+        pre_commands = list(value) if isinstance(value, list) else [value]
+    value = file_result.get("postBootstrapCommands")
+    if value:
+        post_commands = list(value) if isinstance(value, list) else [value]
     return {"pre": pre_commands, "post": post_commands}
 
 
@@ -384,7 +363,10 @@ def check_resource_group(cmd, resource_group_name, default_resource_group_name,
     Check if the RG already exists and that it's consistent with the location
     specified. CAPZ will actually create (and delete) the RG if needed.
     """
-    from ._client_factory import cf_resource_groups  # pylint: disable=import-outside-toplevel
+    # pylint: disable=import-outside-toplevel
+    from azure.core.exceptions import ResourceNotFoundError as ResourceNotFoundException
+    from msrestazure.azure_exceptions import CloudError
+    from ._client_factory import cf_resource_groups
 
     rg_client = cf_resource_groups(cmd.cli_ctx)
     if not resource_group_name:
@@ -416,12 +398,12 @@ def create_workload_cluster(  # pylint: disable=too-many-arguments,too-many-loca
         capi_name=None,
         resource_group_name=None,
         location=None,
-        control_plane_machine_type=os.environ.get("AZURE_CONTROL_PLANE_MACHINE_TYPE", "Standard_B2s"),
-        control_plane_machine_count=os.environ.get("CONTROL_PLANE_MACHINE_COUNT", 3),
-        node_machine_type=os.environ.get("AZURE_NODE_MACHINE_TYPE", "Standard_B2s"),
-        node_machine_count=os.environ.get("WORKER_MACHINE_COUNT", 3),
-        kubernetes_version=os.environ.get("KUBERNETES_VERSION", "v1.25.3"),
-        ssh_public_key=os.environ.get("AZURE_SSH_PUBLIC_KEY", ""),
+        control_plane_machine_type=None,
+        control_plane_machine_count=None,
+        node_machine_type=None,
+        node_machine_count=None,
+        kubernetes_version=None,
+        ssh_public_key=None,
         external_cloud_provider=True,
         management_cluster_name=None,
         management_cluster_resource_group_name=None,
@@ -439,6 +421,14 @@ def create_workload_cluster(  # pylint: disable=too-many-arguments,too-many-loca
     if location is None:
         location = os.environ.get("AZURE_LOCATION", None)
 
+    # Resolve environment variable defaults per call, not when this module was imported.
+    control_plane_machine_type = workload_cluster_default("control_plane_machine_type", control_plane_machine_type)
+    control_plane_machine_count = workload_cluster_default("control_plane_machine_count", control_plane_machine_count)
+    node_machine_type = workload_cluster_default("node_machine_type", node_machine_type)
+    node_machine_count = workload_cluster_default("node_machine_count", node_machine_count)
+    kubernetes_version = workload_cluster_default("kubernetes_version", kubernetes_version)
+    ssh_public_key = workload_cluster_default("ssh_public_key", ssh_public_key)
+
     wait_for_nodes = int(wait_for_nodes)
 
     if not capi_name:
@@ -447,39 +437,32 @@ def create_workload_cluster(  # pylint: disable=too-many-arguments,too-many-loca
 
     if not kubernetes_version.startswith('v'):
         kubernetes_version = f'v{kubernetes_version}'
+    import semver  # pylint: disable=import-outside-toplevel
+    # semver 3 renamed VersionInfo to Version and deprecated the old name.
+    version_class = getattr(semver, "Version", None) or semver.VersionInfo
     try:
-        semver.VersionInfo.parse(kubernetes_version[1:])
+        version_class.parse(kubernetes_version[1:])
     except ValueError as err:
         raise InvalidArgumentValueError(f'Invalid Kubernetes version: "{kubernetes_version}"') from err
 
     # Warn that some `az capi create` flags expect template variables
     # that may not be present in a user-provided template.
     if user_provided_template:
-        mutual_exclusive_args = [
-            {
-                "name": "external_cloud_provider",
-                "value": external_cloud_provider
-            },
-            {
-                "name": "machinepool",
-                "value": machinepool
-            },
-            {
-                "name": "ephemeral_disks",
-                "value": ephemeral_disks
-            }
-        ]
-        defined_args = [v["name"] for v in mutual_exclusive_args if v["value"]]
+        mutual_exclusive_args = (
+            ("external_cloud_provider", external_cloud_provider),
+            ("machinepool", machinepool),
+            ("ephemeral_disks", ephemeral_disks),
+        )
+        defined_args = ", ".join(name for name, value in mutual_exclusive_args if value)
         if defined_args:
-            defined_args = " ,".join(defined_args)
             warning_msg = f'The following arguments may not work with "--template":\n{defined_args}'
             logger.warning(warning_msg)
 
     bootstrap_cmds = get_default_bootstrap_commands(windows)
     if bootstrap_commands:
         kubeadm_file_commands = parse_bootstrap_commands_from_file(bootstrap_commands)
-        bootstrap_cmds["pre"] += kubeadm_file_commands["pre"]
-        bootstrap_cmds["post"] += kubeadm_file_commands["post"]
+        bootstrap_cmds["pre"].extend(kubeadm_file_commands["pre"])
+        bootstrap_cmds["post"].extend(kubeadm_file_commands["post"])
 
     check_resource_group(cmd, resource_group_name, capi_name, location)
 
@@ -496,10 +479,13 @@ def create_workload_cluster(  # pylint: disable=too-many-arguments,too-many-loca
         return
 
     # Generate the cluster configuration
-    ssh_public_key_b64 = ""
-    if ssh_public_key:
-        ssh_public_key_b64 = base64.b64encode(ssh_public_key.encode("utf-8"))
-        ssh_public_key_b64 = str(ssh_public_key_b64, "utf-8")
+    # The key's comment field may contain non-ASCII text, but base64 output is always ASCII.
+    ssh_public_key_b64 = base64.b64encode(ssh_public_key.encode("utf-8")).decode("ascii") if ssh_public_key else ""
+
+    try:
+        env = {name: os.environ[name] for name in WORKLOAD_CLUSTER_REQUIRED_ENV}
+    except KeyError as err:
+        raise RequiredArgumentMissingError(f"Required environment variable {err.args[0]} was not found.") from err
 
     args = {
         "AZURE_CONTROL_PLANE_MACHINE_TYPE": control_plane_machine_type,
@@ -514,12 +500,12 @@ def create_workload_cluster(  # pylint: disable=too-many-arguments,too-many-loca
         "KUBERNETES_VERSION": kubernetes_version,
         "WORKER_MACHINE_COUNT": node_machine_count,
         "NODEPOOL_TYPE": "machinepool" if machinepool else "machinedeployment",
-        "CLUSTER_IDENTITY_NAME": os.environ["CLUSTER_IDENTITY_NAME"],
-        "AZURE_SUBSCRIPTION_ID": os.environ['AZURE_SUBSCRIPTION_ID'],
-        "AZURE_TENANT_ID": os.environ["AZURE_TENANT_ID"],
-        "AZURE_CLIENT_ID": os.environ["AZURE_CLIENT_ID"],
-        "AZURE_CLUSTER_IDENTITY_SECRET_NAME": os.environ["AZURE_CLUSTER_IDENTITY_SECRET_NAME"],
-        "AZURE_CLUSTER_IDENTITY_SECRET_NAMESPACE": os.environ["AZURE_CLUSTER_IDENTITY_SECRET_NAMESPACE"],
+        "CLUSTER_IDENTITY_NAME": env["CLUSTER_IDENTITY_NAME"],
+        "AZURE_SUBSCRIPTION_ID": env["AZURE_SUBSCRIPTION_ID"],
+        "AZURE_TENANT_ID": env["AZURE_TENANT_ID"],
+        "AZURE_CLIENT_ID": env["AZURE_CLIENT_ID"],
+        "AZURE_CLUSTER_IDENTITY_SECRET_NAME": env["AZURE_CLUSTER_IDENTITY_SECRET_NAME"],
+        "AZURE_CLUSTER_IDENTITY_SECRET_NAMESPACE": env["AZURE_CLUSTER_IDENTITY_SECRET_NAMESPACE"],
         "PRE_BOOTSTRAP_CMDS": bootstrap_cmds["pre"],
         "POST_BOOTSTRAP_CMDS": bootstrap_cmds["post"],
         "AKS_INFRA_RG_NAME": os.environ.get(AKS_INFRA_RG_NAME, None),
@@ -532,35 +518,43 @@ def create_workload_cluster(  # pylint: disable=too-many-arguments,too-many-loca
     filename = capi_name + ".yaml"
     generate_workload_cluster_configuration(cmd, filename, args, user_provided_template)
 
+    # Download and render the Windows proxy manifests in the background while the cluster comes up.
+    proxy_render = None
+    if windows:
+        # clusterctl reads the template variables from the environment, so set them here rather than in the worker.
+        set_environment_variables(args)
+        executor = ThreadPoolExecutor(max_workers=1)
+        proxy_render = executor.submit(render_windows_proxy_manifests, bool(os.environ.get("WINDOWS_KPNG")))
+        # Shut down without waiting: the render still runs, but an error below is reported without waiting for it.
+        executor.shutdown(wait=False)
+
     # Apply the cluster configuration.
-    attempts, delay = 100, 3
     begin_msg = f'Creating workload cluster "{capi_name}"'
     end_msg = f'✓ Created workload cluster "{capi_name}"'
     with Spinner(cmd, begin_msg, end_msg):
         command = ["kubectl", "apply", "-f", filename]
         try:
-            retry_shell_command(command, attempts, delay)
+            retry_with_backoff(lambda: run_shell_command(command))
         except subprocess.CalledProcessError as err:
             msg = "Couldn't apply workload cluster manifest after waiting 5 minutes."
             raise ResourceNotFoundError(msg) from err
 
     # Write the kubeconfig for the workload cluster to a file.
     # Retry this operation several times, then give up and just print the command.
-    attempts, delay = 100, 3
     with Spinner(cmd, "Waiting for access to workload cluster", "✓ Workload cluster is accessible"):
-        for _ in range(attempts):
-            try:
-                kubectl_helpers.get_kubeconfig(capi_name)
-                break
-            except UnclassifiedUserFault:
-                time.sleep(delay)
-        else:
+        try:
+            retry_with_backoff(lambda: kubectl_helpers.get_kubeconfig(capi_name),
+                               exceptions=(UnclassifiedUserFault,))
+        except UnclassifiedUserFault as err:
             msg = f"""\
 Kubeconfig wasn't available after waiting 5 minutes.
 When the cluster is ready, run this command to fetch the kubeconfig:
 clusterctl get kubeconfig {capi_name}
 """
-            raise ResourceNotFoundError(msg)
+            raise ResourceNotFoundError(msg) from err
+
+    # Report any render error now, before add-ons are installed on the workload cluster.
+    proxy_manifests = proxy_render.result() if proxy_render else None
 
     workload_cfg = capi_name + ".kubeconfig"
     logger.warning('✓ Workload access configuration written to "%s"', workload_cfg)
@@ -573,7 +567,7 @@ clusterctl get kubeconfig {capi_name}
         install_cloud_provider(cmd, capi_name, workload_cfg, cidr0, cidr1)
 
     # Install CNI
-    install_cni(cmd, workload_cfg, cidr0, cidr1, windows, args)
+    install_cni(cmd, workload_cfg, cidr0, cidr1, windows, proxy_manifests)
 
     # Wait for a node (or all nodes) to be ready before returning
     if wait_for_nodes > 0:
@@ -590,18 +584,16 @@ def get_cidrs(cmd, cluster_name):
     # Find the provisioned network range(s) and return them as CIDRs.
     # See https://en.wikipedia.org/wiki/Classless_Inter-Domain_Routing for more information about CIDRs.
     cidr0, cidr1 = "", ""
-    attempts, delay = 10, 3
     with Spinner(cmd, "Finding provisioned network ranges", "✓ Found provisioned network ranges"):
         command = ["kubectl", "get", "cluster", cluster_name, "-o=jsonpath={.spec.clusterNetwork.pods.cidrBlocks[0]}"]
         try:
-            cidr0 = retry_shell_command(command, attempts, delay)
-        except subprocess.CalledProcessError:
+            cidr0 = retry_shell_command(command, timeout=30)
+        except subprocess.SubprocessError:
             pass  # This is a best-effort configuration, so don't fail if we can't find the CIDR.
-        attempts = 5
         command = ["kubectl", "get", "cluster", cluster_name, "-o=jsonpath={.spec.clusterNetwork.pods.cidrBlocks[1]}"]
         try:
-            cidr1 = retry_shell_command(command, attempts, delay)
-        except subprocess.CalledProcessError:
+            cidr1 = retry_shell_command(command, timeout=15)
+        except subprocess.SubprocessError:
             pass  # This is a best-effort configuration, so don't fail if we can't find the CIDR.
     return cidr0, cidr1
 
@@ -624,7 +616,7 @@ def install_cloud_provider(cmd, cluster_name, workload_cfg, cidr0, cidr1):
     install_helm_chart(cmd, helminfo, workload_cfg, "Deploy cloud-provider-azure support")
 
 
-def install_cni(cmd, workload_cfg, cidr0, cidr1, windows, args):
+def install_cni(cmd, workload_cfg, cidr0, cidr1, windows, proxy_manifests=None):
     # Install Calico CNI using the official Helm chart.
     values_file = f"{CAPZ_BASE_CONTENT_URL}/templates/addons/calico/values.yaml"
     if cidr0 and not cidr1:
@@ -653,47 +645,25 @@ def install_cni(cmd, workload_cfg, cidr0, cidr1, windows, args):
         helminfo.args.extend(["--set-string", f"installation.calicoNetwork.ipPools[1].cidr={cidr1}"])
     install_helm_chart(cmd, helminfo, workload_cfg, "Deploy container network interface (CNI) support")
     if windows:
-        install_cni_windows(cmd, workload_cfg, "Deploy Windows Calico support")
-        windows_kpng = os.environ.get('WINDOWS_KPNG')
-        if not windows_kpng:
-            install_windows_kubeproxy(cmd, args, workload_cfg, "Deploy Windows kube-proxy")
-        else:
-            install_windows_kpng(cmd, args, workload_cfg, "Deploy Windows kpng")
+        install_cni_windows(cmd, workload_cfg, "Deploy Windows Calico and service proxy support", proxy_manifests)
 
 
-def install_cni_windows(cmd, workload_cfg, msg):
+def install_cni_windows(cmd, workload_cfg, msg, proxy_manifests=None):
     """Copy a configmap and install Windows CNI via manifest: workarounds until the Helm chart supports Windows."""
     configmap = get_configmap(workload_cfg, "kubeadm-config", "kube-system")
     configmap = configmap.replace("namespace: kube-system", "namespace: calico-system")
     create_configmap(workload_cfg, configmap)
     calico_manifest = f"{CAPZ_BASE_CONTENT_URL}/templates/addons/windows/calico/calico.yaml"  # pylint: disable=line-too-long
-    apply_kubernetes_manifest(cmd, calico_manifest, workload_cfg, msg)
+    apply_kubernetes_manifests(cmd, [calico_manifest], workload_cfg, msg)
 
     calico_version = os.environ.get("CALICO_VERSION", DEFAULT_CALICO_VERSION)
     update_kubernetes_image(cmd, "calico-system", "daemonSet/calico-node-windows", "install-cni", f"sigwindowstools/calico-install:{calico_version}-hostprocess", workload_cfg, msg)
     update_kubernetes_image(cmd, "calico-system", "daemonSet/calico-node-windows", "calico-node-startup", f"sigwindowstools/calico-node:{calico_version}-hostprocess", workload_cfg, msg)
     update_kubernetes_image(cmd, "calico-system", "daemonSet/calico-node-windows", "calico-node-felix", f"sigwindowstools/calico-node:{calico_version}-hostprocess", workload_cfg, msg)
 
-
-def install_windows_kubeproxy(cmd, args, workload_cfg, msg):
-    kubeproxy_manifest_url = f"{CAPZ_BASE_CONTENT_URL}/templates/addons/windows/calico/kube-proxy-windows.yaml"  # pylint: disable=line-too-long
-    kubeproxy_manifest_file = "kube-proxy-windows.yaml"
-    manifest = render_custom_cluster_template(kubeproxy_manifest_url, kubeproxy_manifest_file, args)
-    write_to_file(kubeproxy_manifest_file, manifest)
-    apply_kubernetes_manifest(cmd, kubeproxy_manifest_file, workload_cfg, msg)
-
-
-def install_windows_kpng(cmd, args, workload_cfg, msg):
-    kpng_rbac_manifest_url = "https://raw.githubusercontent.com/kubernetes-sigs/windows-service-proxy/main/deploy/kpng-rbac.yaml"  # pylint: disable=line-too-long
-    kpng_rbac_manifest_file = "kpng-rback.yaml"
-    kpng_rbac_manifest = render_custom_cluster_template(kpng_rbac_manifest_url, kpng_rbac_manifest_file, args)
-    write_to_file(kpng_rbac_manifest_file, kpng_rbac_manifest)
-    apply_kubernetes_manifest(cmd, kpng_rbac_manifest_file, workload_cfg, "Deploy Windows kpng-rbac rules")
-    kpng_manifest_url = "https://raw.githubusercontent.com/kubernetes-sigs/windows-service-proxy/main/deploy/kpng-windows-capz-calico.yaml"  # pylint: disable=line-too-long
-    kpng_manifest_file = "kpng.yaml"
-    kpng_manifest = render_custom_cluster_template(kpng_manifest_url, kpng_manifest_file, args)
-    write_to_file(kpng_manifest_file, kpng_manifest)
-    apply_kubernetes_manifest(cmd, kpng_manifest_file, workload_cfg, msg)
+    # Apply the rendered kube-proxy (or kpng) manifests once the Calico images are updated, as before.
+    if proxy_manifests:
+        apply_kubernetes_manifests(cmd, proxy_manifests, workload_cfg, msg)
 
 
 def pivot_cluster(cmd, target_cluster_kubeconfig):
@@ -725,57 +695,64 @@ def pivot_cluster(cmd, target_cluster_kubeconfig):
 def delete_kind_cluster(cmd, name):
     command = ["kind", "delete", "cluster", "--name", name]
     try_command_with_spinner(cmd, command, f"Delete {name} kind cluster")
+    forget_management_cluster()
 
 
 def delete_kind_cluster_from_current_context(cmd):
-    cluster_name = kubectl_helpers.find_cluster_in_current_context()
-    # remove prefix
-    if has_kind_prefix(cluster_name):
-        cluster_name = cluster_name[5:]
+    cluster_name = strip_kind_prefix(kubectl_helpers.find_cluster_in_current_context())
     delete_kind_cluster(cmd, cluster_name)
 
 
 def delete_aks_cluster(cmd, name, resource_group):
-    command = ["az", "aks", "delete", "--name", name, "--resource-group", resource_group, "--yes"]
-    try_command_with_spinner(cmd, command, f"Delete {name} AKS cluster")
-    command = ["az", "group", "delete", "--name", resource_group, "--yes"]
-    try_command_with_spinner(cmd, command, f"Delete {name} resource group")
+    # Deleting the resource group deletes the AKS cluster in it, so don't wait on a separate "az aks delete".
+    delete_resource_group(cmd, resource_group, f"Delete {name} resource group")
     # Need to clean kubeconfig context
-    kubectl_helpers.reset_current_context_and_attributes()
+    reset_current_context()
     return True
 
 
-def apply_kubernetes_manifest(cmd, manifest, workload_cfg, msg):
+def reset_current_context():
+    """Remove the current kubeconfig context and forget any management cluster found through it."""
+    kubectl_helpers.reset_current_context_and_attributes()
+    forget_management_cluster()
+
+
+def apply_kubernetes_manifests(cmd, manifests, workload_cfg, msg):
     begin_msg, end_msg, err_msg = message_variants(msg)
-    attempts, delay = 100, 3
     with Spinner(cmd, begin_msg, end_msg):
-        command = ["kubectl", "apply", "-f", manifest, "--kubeconfig", workload_cfg]
+        command = ["kubectl", "apply"]
+        for manifest in manifests:
+            command += ["-f", manifest]
+        command += ["--kubeconfig", workload_cfg]
+        timeout = 300
+        deadline = time.monotonic() + timeout
         try:
-            retry_shell_command(command, attempts, delay)
-        except subprocess.CalledProcessError as err:
+            # Kill a hung kubectl rather than let it outlive the retry budget.
+            retry_with_backoff(lambda: run_kubectl_apply(command, timeout=max(1, deadline - time.monotonic())),
+                               total_timeout=timeout, initial=1.0, cap=30.0,
+                               exceptions=(subprocess.CalledProcessError, subprocess.TimeoutExpired))
+        except subprocess.SubprocessError as err:
             raise ResourceNotFoundError(err_msg) from err
 
 
 def update_kubernetes_image(cmd, namespace, resource_name, container_name, new_image_name, workload_cfg, msg):
     begin_msg, end_msg, err_msg = message_variants(msg)
-    attempts, delay = 100, 3
     with Spinner(cmd, begin_msg, end_msg):
         command = ["kubectl", "set", "image", "-n", namespace, resource_name, f"{container_name}={new_image_name}", "--kubeconfig", workload_cfg]
         try:
-            retry_shell_command(command, attempts, delay)
-        except subprocess.CalledProcessError as err:
+            retry_shell_command(command)
+        except subprocess.SubprocessError as err:
             raise ResourceNotFoundError(err_msg) from err
 
 
 def install_helm_chart(cmd, helminfo, workload_cfg, msg):
     begin_msg, end_msg, err_msg = message_variants(msg)
-    attempts, delay = 100, 3
     with Spinner(cmd, begin_msg, end_msg):
         command = ["helm", "repo", "add", helminfo.repo_name, helminfo.repo_url,
                    "--kubeconfig", workload_cfg, "--force-update"]
         try:
-            retry_shell_command(command, attempts, delay)
-        except subprocess.CalledProcessError as err:
+            retry_shell_command(command)
+        except subprocess.SubprocessError as err:
             raise ResourceNotFoundError(err_msg) from err
         command = ["helm", "install", helminfo.chart_name, helminfo.chart, "--kubeconfig", workload_cfg]
         if helminfo.values_file:
@@ -783,12 +760,12 @@ def install_helm_chart(cmd, helminfo, workload_cfg, msg):
         if helminfo.args:
             command.extend(helminfo.args)
         try:
-            retry_shell_command(command, attempts, delay)
-        except subprocess.CalledProcessError as err:
+            retry_shell_command(command)
+        except subprocess.SubprocessError as err:
             raise ResourceNotFoundError(err_msg) from err
 
 
-def delete_workload_cluster(cmd, capi_name, resource_group_name=None, yes=False):
+def delete_workload_cluster(cmd, capi_name, resource_group_name=None, yes=False, no_wait=False):
     exit_if_no_management_cluster()
     msg = f'Do you want to delete this Kubernetes cluster "{capi_name}"?'
     command = ["kubectl", "delete", "cluster", capi_name]
@@ -797,25 +774,40 @@ def delete_workload_cluster(cmd, capi_name, resource_group_name=None, yes=False)
         if not resource_group_name:
             resource_group_name = get_azure_resource_group_from_azure_cluster(capi_name)
         msg = f'Do you want to delete the {capi_name} Kubernetes cluster and {resource_group_name} resource group?'
-        command = ["az", "group", "delete", "-n", resource_group_name, '-y']
     if not yes and not prompt_y_n(msg, default="n"):
         return
     # if capi_name == kubectl_helpers.find_cluster_in_current_context():
     #     end_msg += f'\nNote: To also delete the management cluster, run "az capi management delete -n {capi_name}"'
-    try_command_with_spinner(cmd, command, "Delete workload cluster")
     if is_self_managed:
-        kubectl_helpers.reset_current_context_and_attributes()
+        delete_resource_group(cmd, resource_group_name, "Delete workload cluster", no_wait)
+        reset_current_context()
+    else:
+        if no_wait:
+            # Return once the delete is accepted, leaving CAPI to run the finalizers in the background.
+            command.append("--wait=false")
+        try_command_with_spinner(cmd, command, "Delete workload cluster")
+
+
+# One kubectl get answers both whether a cluster is self-managed and which resource group it lives in.
+@lru_cache(maxsize=4)
+def get_azure_cluster_info(cluster_name, kubeconfig=None):
+    return kubectl_helpers.get_azure_cluster_info(cluster_name, kubeconfig)
 
 
 def get_azure_resource_group_from_azure_cluster(cluster_name, kubeconfig=None):
-    output = kubectl_helpers.get_azure_cluster(cluster_name, kubeconfig)
-    return json.loads(output)["spec"]["resourceGroup"]
+    return get_azure_cluster_info(cluster_name, kubeconfig).resource_group
 
 
 def is_self_managed_cluster(cluster_name):
-    management_cluster_ports = kubectl_helpers.get_ports_cluster()
-    workload_cluster_ports = kubectl_helpers.get_ports_cluster(f"{cluster_name}.kubeconfig")
-    return management_cluster_ports == workload_cluster_ports
+    """Return True if the workload cluster's API server is the one the current kubeconfig points to."""
+    try:
+        azure_cluster = get_azure_cluster_info(cluster_name)
+    except InvalidArgumentValueError:
+        return False
+    if not azure_cluster.host:
+        return False  # Not provisioned yet, so it can't be serving the current context.
+    server = urlparse(kubectl_helpers.get_current_server())
+    return (server.hostname, server.port or 443) == (azure_cluster.host, azure_cluster.port or 443)
 
 
 def list_workload_clusters(cmd):  # pylint: disable=unused-argument
@@ -824,7 +816,7 @@ def list_workload_clusters(cmd):  # pylint: disable=unused-argument
         output = run_shell_command(["kubectl", "get", "clusters", "-o", "json"])
     except subprocess.CalledProcessError as err:
         raise UnclassifiedUserFault("Couldn't list workload clusters") from err
-    return output_list_for_tsv(output) if tab_separated_output(cmd) else json.loads(output)
+    return output_list_for_tsv(output) if tab_separated_output(cmd) else json_loads(output)
 
 
 def tab_separated_output(cmd):
@@ -843,7 +835,7 @@ def show_workload_cluster(cmd, capi_name):  # pylint: disable=unused-argument
         raise UnclassifiedUserFault(f"Couldn't get the workload cluster {capi_name}") from err
     if tab_separated_output(cmd):
         return output_for_tsv(output)
-    return json.loads(output)
+    return json_loads(output)
 
 
 def update_workload_cluster(cmd, capi_name):
@@ -859,9 +851,8 @@ def install_tools(cmd, all_tools=False, install_path=None):
 
 
 def check_tools(cmd, install=False, install_path=None):
-    check_kubectl(cmd, install=install, install_path=install_path)
-    check_clusterctl(cmd, install=install, install_path=install_path)
-    check_helm(cmd, install=install, install_path=install_path)
+    tools = [("kubectl", install_kubectl), ("clusterctl", install_clusterctl), ("helm", install_helm)]
+    check_binaries(cmd, tools, install=install, install_path=install_path)
 
 
 def check_prereqs(cmd, install=False):
@@ -870,9 +861,18 @@ def check_prereqs(cmd, install=False):
     check_environment_variables()
 
 
+_environment_variables_checked = False  # pylint: disable=invalid-name
+# A tuple rather than a set, so missing variables are reported in a stable order.
+_REQUIRED_ENV_VARS = ("AZURE_CLIENT_ID", "AZURE_CLIENT_SECRET", "AZURE_SUBSCRIPTION_ID", "AZURE_TENANT_ID")
+
+
 def check_environment_variables():
-    required_env_vars = ["AZURE_CLIENT_ID", "AZURE_CLIENT_SECRET", "AZURE_SUBSCRIPTION_ID", "AZURE_TENANT_ID"]
-    missing_env_vars = [v for v in required_env_vars if not check_environment_var(v)]
+    # Environment variables don't change during a command, so only check them once.
+    global _environment_variables_checked  # pylint: disable=global-statement,invalid-name
+    if _environment_variables_checked:
+        return
+    encoded_env_vars = {var: get_b64_environment_var(var) for var in _REQUIRED_ENV_VARS}
+    missing_env_vars = [var for var, value in encoded_env_vars.items() if value is None]
     missing_vars_len = len(missing_env_vars)
     if missing_vars_len > 0:
         err_msg = f"Required environment variable {missing_env_vars[0]} was not found."
@@ -880,53 +880,67 @@ def check_environment_variables():
             missing_env_vars = ", ".join(missing_env_vars)
             err_msg = f"Required environment variables {missing_env_vars} were not found."
         raise RequiredArgumentMissingError(err_msg)
+    # Set the base64-encoded variables as a convenience, skipping any that are already set
+    for var, value in encoded_env_vars.items():
+        var_b64 = f"{var}_B64"
+        if os.environ.get(var_b64) == value:
+            logger.info("Found environment variable %s", var_b64)
+        else:
+            os.environ[var_b64] = value
+            logger.info("Set environment variable %s from %s", var_b64, var)
+    _environment_variables_checked = True
 
 
-def check_environment_var(var):
-    var_b64 = var + "_B64"
-    val = os.environ.get(var_b64)
+def get_b64_environment_var(var):
+    """Return the value of var_B64 if set, else var's value base64-encoded, or None if neither is set."""
+    val = os.environ.get(var + "_B64")
     if val:
-        logger.info("Found environment variable %s", var_b64)
-    else:
-        try:
-            val = os.environ[var]
-        except KeyError:
-            return False
-        # Set the base64-encoded variable as a convenience
-        val = base64.b64encode(val.encode("utf-8")).decode("ascii")
-        os.environ[var_b64] = val
-        logger.info("Set environment variable %s from %s", var_b64, var)
-    return True
+        return val
+    val = os.environ.get(var)
+    return base64.b64encode(val.encode("utf-8")).decode("ascii") if val is not None else None
 
 
-def find_management_cluster_retry(cmd, delay=3):
+def find_management_cluster_retry(cmd, timeout=30):
+    kubeconfig = os.environ.get(KUBECONFIG)
+    context = kubectl_helpers.find_kubectl_current_context()
     with Spinner(cmd, "Waiting for Cluster API to be ready", "✓ Cluster API is ready"):
-        last_err_msg = None
-        for _ in range(0, 10):
+        deadline = time.monotonic() + timeout
+        attempt = 0
+        while True:
             try:
-                find_management_cluster()
-                break
+                # A success is remembered, so later checks in this command return at once.
+                _verify_management_cluster(kubeconfig, context)
+                return True
             except ResourceNotFoundError as err:
-                last_err_msg = err.error_msg
-                if management_cluster_components_missing_matching_expressions(last_err_msg):
+                if management_cluster_components_missing_matching_expressions(err.error_msg):
                     raise
-                time.sleep(delay)
-        else:
-            raise ResourceNotFoundError(last_err_msg)
-        return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise
+                if attempt == 0:
+                    # Let the apiserver report when provider pods become Ready instead of polling for them.
+                    try:
+                        kubectl_helpers.wait_for_provider_pods(max(1, remaining))
+                    except subprocess.CalledProcessError as wait_err:
+                        logger.info(wait_err)
+                else:
+                    time.sleep(min(remaining, backoff_delay(attempt, initial=0.5, cap=4.0)))
+                attempt += 1
+
+
+# One alternation, so the output is scanned once rather than once per pattern.
+_MGMT_COMPONENT_MISSING_RE = re.compile(
+    r"namespace: .+?could not be found"
+    r"|No resources found in .+?namespace"
+    r"|No .+? installation found"
+)
 
 
 def management_cluster_components_missing_matching_expressions(output):
-    reg_match = [r"namespace: .+?could not be found",
-                 r"No resources found in .+?namespace",
-                 r"No .+? installation found"]
-    for exp in reg_match:
-        if match_output(output, exp):
-            return True
+    return bool(_MGMT_COMPONENT_MISSING_RE.search(output))
 
 
 def find_management_cluster():
-    kubectl_helpers.find_default_cluster()
     components = [
         {
             "namespace": "capz-system",
@@ -949,14 +963,33 @@ def find_management_cluster():
             "pod": "capi-kubeadm-control-plane-controller-manager"
         }
     ]
+    # List every provider pod with one query and check the components locally. The query also
+    # proves the API server is reachable, so a separate "kubectl cluster-info" isn't needed.
+    pods = kubectl_helpers.get_provider_pods()
     for component in components:
-        kubectl_helpers.check_kubectl_namespace(component["namespace"])
-        kubectl_helpers.check_pods_status_by_namespace(component["namespace"], component["err_msg"], component["pod"])
+        phases = [phase for namespace, name, phase in pods
+                  if namespace == component["namespace"] and name.startswith(component["pod"] + "-")]
+        if not phases:
+            raise ResourceNotFoundError(component["err_msg"])
+        if "Running" not in phases:
+            raise ResourceNotFoundError(f"No pods running in {component['namespace']} namespace")
+
+
+@lru_cache(maxsize=4)
+def _verify_management_cluster(kubeconfig, context):  # pylint: disable=unused-argument
+    """Probe for a management cluster. Only successful probes are cached, keyed by the KUBECONFIG and context in use."""
+    find_management_cluster()
+
+
+def forget_management_cluster():
+    """Forget earlier management cluster probes, e.g. after its kubeconfig context was removed."""
+    _verify_management_cluster.cache_clear()
 
 
 def exit_if_no_management_cluster():
+    # A management cluster found once stays reachable for the rest of the command.
     try:
-        find_management_cluster()
+        _verify_management_cluster(os.environ.get(KUBECONFIG), kubectl_helpers.find_kubectl_current_context())
     except (ResourceNotFoundError, subprocess.CalledProcessError) as err:
         msg = 'No management cluster found. Please create one with "az capi management create".'
         raise UnclassifiedUserFault(msg) from err
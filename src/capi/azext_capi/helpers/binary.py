@@ -5,10 +5,12 @@
 
 # pylint: disable=missing-docstring
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import os
 import platform
-import stat
-import tarfile
+import shutil
+import tempfile
 
 from azure.cli.core.azclierror import FileOperationError
 from azure.cli.core.azclierror import InvalidArgumentValueError
@@ -16,6 +18,7 @@ from azure.cli.core.azclierror import ValidationError, UnclassifiedUserFault
 from knack.prompting import prompt_y_n
 from six.moves.urllib.request import urlopen  # pylint: disable=import-error
 
+from azext_capi.helpers.discovery_cache import cached
 from azext_capi.helpers.network import ssl_context, urlretrieve
 from azext_capi._params import _get_default_install_location
 from azext_capi.helpers.logger import logger
@@ -23,28 +26,15 @@ from azext_capi.helpers.spinner import Spinner
 
 
 def which(binary):
-    path_var = os.getenv("PATH")
-
-    if platform.system() == "Windows":
-        binary += ".exe"
-        parts = path_var.split(";")
-    else:
-        parts = path_var.split(":")
-
-    for part in parts:
-        bin_path = os.path.join(part, binary)
-        if os.path.isfile(bin_path) and os.access(bin_path, os.X_OK):
-            return bin_path
-
-    return None
-
-
-def check_clusterctl(cmd, install=False, install_path=None):
-    check_binary(cmd, "clusterctl", install_clusterctl, install=install, install_path=install_path)
+    return _which(binary, os.environ.get("PATH", ""))
 
 
-def check_helm(cmd, install=False, install_path=None):
-    check_binary(cmd, "helm", install_helm, install=install, install_path=install_path)
+# PATH lookups stat every directory on PATH, so remember them for as long as PATH is unchanged.
+# download_binary() clears this cache so newly installed tools are found.
+@lru_cache(maxsize=32)
+def _which(binary, path):
+    # shutil.which also honors PATHEXT on Windows, so kubectl.cmd and similar are found.
+    return shutil.which(binary, path=path)
 
 
 def check_kind(cmd, install=False, install_path=None):
@@ -52,10 +42,6 @@ def check_kind(cmd, install=False, install_path=None):
     check_binary(cmd, "kind", install_kind, install=install, install_path=install_path)
 
 
-def check_kubectl(cmd, install=False, install_path=None):
-    check_binary(cmd, "kubectl", install_kubectl, install=install, install_path=install_path)
-
-
 def check_prereq_docker():
     if which("docker"):
         return True
@@ -64,25 +50,51 @@ def check_prereq_docker():
 
 
 def check_binary(cmd, binary_name, install_binary_method, install=False, install_path=None):
-    if not which(binary_name) or install_path is not None:
-        logger.info("%s was not found.", binary_name)
-        if install or prompt_y_n(f"Download and install {binary_name}?", default="n"):
-            with Spinner(cmd, f"Downloading {binary_name}", f"✓ Downloaded {binary_name}"):
-                install_binary_method(cmd, install_location=install_path)
+    check_binaries(cmd, [(binary_name, install_binary_method)], install=install, install_path=install_path)
 
 
+def check_binaries(cmd, binaries, install=False, install_path=None):
+    """
+    Check that each (binary_name, install_binary_method) pair is installed, downloading missing ones together.
+    """
+    # Prompt for each binary first, so the questions stay in order and only the downloads overlap.
+    to_install = []
+    for binary_name, install_binary_method in binaries:
+        if not which(binary_name) or install_path is not None:
+            logger.info("%s was not found.", binary_name)
+            if install or prompt_y_n(f"Download and install {binary_name}?", default="n"):
+                to_install.append((binary_name, install_binary_method))
+    if not to_install:
+        return
+    if install_path is not None:
+        # Create the shared directory up front, so the installers don't race to create it.
+        os.makedirs(install_path, exist_ok=True)
+    names = ", ".join(binary_name for binary_name, _ in to_install)
+    with Spinner(cmd, f"Downloading {names}", f"✓ Downloaded {names}"):
+        with ThreadPoolExecutor(max_workers=len(to_install)) as executor:
+            futures = [executor.submit(install_binary_method, cmd, install_location=install_path)
+                       for _, install_binary_method in to_install]
+            for future in futures:
+                future.result()
+
+
+_ARCH_ALIASES = {"x86_64": "amd64", "aarch64": "arm64", "armv7l": "arm"}
+
+
+# The installers each ask for the host OS and architecture, which can't change during a command.
+@lru_cache(maxsize=1)
+def get_system():
+    """Returns python's platform.system() name for the host, such as "Linux" or "Windows"."""
+    return platform.system()
+
+
+@lru_cache(maxsize=None)
 def get_arch(arch=None):
     """Normalize python's platform.machine() output to match build architectures."""
     if arch is None:
         arch = platform.machine()
     arch = arch.lower()
-    if arch == "x86_64":
-        return "amd64"
-    if arch == "aarch64":
-        return "arm64"
-    if arch == "armv7l":
-        return "arm"
-    return arch
+    return _ARCH_ALIASES.get(arch, arch)
 
 
 def install_clusterctl(_cmd, client_version="latest", install_location=None, source_url=None):
@@ -93,14 +105,12 @@ def install_clusterctl(_cmd, client_version="latest", install_location=None, sou
     if not source_url:
         source_url = "https://github.com/kubernetes-sigs/cluster-api/releases/"
 
-    if client_version != "latest":
-        source_url += "tags/"
-    source_url += "{}/download/clusterctl-{}-{}"
+    release = client_version if client_version == "latest" else f"tags/{client_version}"
 
     file_url = ""
-    system = platform.system()
+    system = get_system()
     if system in ("Darwin", "Linux"):
-        file_url = source_url.format(client_version, system.lower(), get_arch())
+        file_url = f"{source_url}{release}/download/clusterctl-{system.lower()}-{get_arch()}"
     else:
         raise ValidationError(f'The clusterctl binary is not available for "{system}"')
 
@@ -112,8 +122,7 @@ def install_clusterctl(_cmd, client_version="latest", install_location=None, sou
     install_dir, cli = os.path.dirname(install_location), os.path.basename(
         install_location
     )
-    if not os.path.exists(install_dir):
-        os.makedirs(install_dir)
+    os.makedirs(install_dir, exist_ok=True)
 
     return download_binary(install_location, install_dir, file_url, system, cli)
 
@@ -122,9 +131,10 @@ def install_helm(_cmd, client_version="v3.10.2", install_location=None, source_u
     """
     Install Helm, an installer and manager for Kubernetes resources.
     """
+    import tarfile  # pylint: disable=import-outside-toplevel
 
     tag = client_version
-    system = platform.system()
+    system = get_system()
     platform_os = system.lower()
     arch = get_arch()
 
@@ -137,18 +147,33 @@ def install_helm(_cmd, client_version="v3.10.2", install_location=None, source_u
     else:
         install_location = _get_default_install_location("helm")
     install_dir, cli = os.path.dirname(install_location), os.path.basename(install_location)
-    if not os.path.exists(install_dir):
-        os.makedirs(install_dir)
-
-    tarball = f"{install_location}.tar.gz"
-    if download_binary(tarball, install_dir, source_url, system, cli):
-        with tarfile.open(tarball, "r:gz") as tar:
-            for member in tar.getmembers():
-                if member.isreg() and member.name.endswith("helm") or member.name.endswith("helm.exe"):
-                    member.name = os.path.basename(member.name)
-                    tar.extract(member, install_dir)
+    os.makedirs(install_dir, exist_ok=True)
+
+    # Stream the archive straight into tarfile and extract only the helm binary, without saving the tarball.
+    logger.info('Downloading client to "%s" from "%s"', install_location, source_url)
+    temp_path = None
+    try:
+        with urlopen(source_url, context=ssl_context()) as response, \
+                tarfile.open(fileobj=response, mode="r|gz") as tar:
+            for member in tar:
+                # Archives hold e.g. "linux-amd64/helm"; match the file name exactly, not just its suffix.
+                name = os.path.basename(member.name)
+                if member.isreg() and name in ("helm", "helm.exe"):
+                    # Only the member's contents are read, so its path and mode in the archive don't matter.
+                    # As in download_binary, write beside the target and rename it into place.
+                    with tempfile.NamedTemporaryFile(dir=install_dir, prefix=f".{name}.", delete=False) as temp_file:
+                        temp_path = temp_file.name
+                        shutil.copyfileobj(tar.extractfile(member), temp_file)
+                    os.chmod(temp_path, 0o755)
+                    os.replace(temp_path, os.path.join(install_dir, name))
                     break
-        os.remove(tarball)
+    except (IOError, tarfile.TarError) as ex:
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+        err_msg = f"Connection error while attempting to download client ({ex})"
+        raise FileOperationError(err_msg) from ex
+    _which.cache_clear()
+    check_install_dir_in_path(install_dir, system, cli)
 
 
 def install_kind(_cmd, client_version="v0.17.0", install_location=None, source_url=None):
@@ -156,7 +181,7 @@ def install_kind(_cmd, client_version="v0.17.0", install_location=None, source_u
     Install kind, a container-based Kubernetes environment for development and testing.
     """
 
-    system = platform.system()
+    system = get_system()
     platform_os = system.lower()
     arch = get_arch()
     if not source_url:
@@ -170,8 +195,7 @@ def install_kind(_cmd, client_version="v0.17.0", install_location=None, source_u
     install_dir, cli = os.path.dirname(install_location), os.path.basename(
         install_location
     )
-    if not os.path.exists(install_dir):
-        os.makedirs(install_dir)
+    os.makedirs(install_dir, exist_ok=True)
 
     return download_binary(install_location, install_dir, source_url, system, cli)
 
@@ -188,14 +212,13 @@ def install_kubectl(cmd, client_version="latest", install_location=None, source_
             source_url = "https://mirror.azure.cn/kubernetes/kubectl"
 
     if client_version == "latest":
-        with urlopen(source_url + "/stable.txt", context=ssl_context()) as manifest:
-            client_version = manifest.read().decode("utf-8").strip()
+        stable_url = f"{source_url}/stable.txt"
+        client_version = cached(stable_url, lambda: get_stable_version(stable_url))
     else:
         client_version = f"v{client_version}"
 
     file_url = ""
-    system = platform.system()
-    base_url = source_url + "/{}/bin/{}/{}/{}"
+    system = get_system()
 
     # ensure installation directory exists
     if install_location is not None:
@@ -205,16 +228,12 @@ def install_kubectl(cmd, client_version="latest", install_location=None, source_
     install_dir, cli = os.path.dirname(install_location), os.path.basename(
         install_location
     )
-    if not os.path.exists(install_dir):
-        os.makedirs(install_dir)
+    os.makedirs(install_dir, exist_ok=True)
 
     arch = get_arch()
-    if system == "Windows":
-        file_url = base_url.format(client_version, "windows", arch, "kubectl.exe")
-    elif system == "Linux":
-        file_url = base_url.format(client_version, "linux", arch, "kubectl")
-    elif system == "Darwin":
-        file_url = base_url.format(client_version, "darwin", arch, "kubectl")
+    if system in ("Windows", "Linux", "Darwin"):
+        binary = "kubectl.exe" if system == "Windows" else "kubectl"
+        file_url = f"{source_url}/{client_version}/bin/{system.lower()}/{arch}/{binary}"
     else:
         raise InvalidArgumentValueError(
             f"Proxy server ({system}) does not exist on the cluster."
@@ -223,22 +242,40 @@ def install_kubectl(cmd, client_version="latest", install_location=None, source_
     return download_binary(install_location, install_dir, file_url, system, cli)
 
 
+def get_stable_version(stable_url):
+    """Returns the release version published at a Kubernetes stable.txt URL."""
+    with urlopen(stable_url, context=ssl_context()) as manifest:
+        return manifest.read().decode("utf-8").strip()
+
+
 def download_binary(install_location, install_dir, file_url, system, cli):
 
     logger.info('Downloading client to "%s" from "%s"', install_location, file_url)
+    # Download beside the target and rename it into place, so an interrupted download never
+    # leaves a broken binary on the search PATH.
+    with tempfile.NamedTemporaryFile(dir=install_dir, prefix=f".{cli}.", delete=False) as temp_file:
+        temp_path = temp_file.name
     try:
-        urlretrieve(file_url, install_location)
-        os.chmod(
-            install_location,
-            os.stat(install_location).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
-        )
+        urlretrieve(file_url, temp_path)
+        # We just wrote the file, so set the mode outright instead of stat-ing it first.
+        os.chmod(temp_path, 0o755)
+        os.replace(temp_path, install_location)
     except IOError as ex:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
         err_msg = f"Connection error while attempting to download client ({ex})"
         raise FileOperationError(err_msg) from ex
+    _which.cache_clear()
+    check_install_dir_in_path(install_dir, system, cli)
+    return install_location
 
+
+def check_install_dir_in_path(install_dir, system, cli):
     if system == "Windows":
         # be verbose, as the install_location is likely not in Windows's search PATHs
-        env_paths = os.environ["PATH"].split(";")
+        env_paths = os.environ.get("PATH", "").split(os.pathsep)
         found = next(
             (x for x in env_paths if x.lower().rstrip("\\") == install_dir.lower()),
             None,
@@ -255,10 +292,11 @@ def download_binary(install_location, install_dir, file_url, system, cli):
                 install_dir, cli, install_dir, install_dir,
             )
     else:
-        if not which(cli):
+        # The binary was just written to install_dir, so checking PATH for that directory is enough.
+        env_paths = os.environ.get("PATH", "").split(os.pathsep)
+        if install_dir.rstrip("/") not in (x.rstrip("/") for x in env_paths):
             logger.warning(
                 "Please ensure that %s is in your search PATH, so the `%s` command can be found.",
                 install_dir,
                 cli,
             )
-    return install_location
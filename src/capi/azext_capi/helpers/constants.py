@@ -13,3 +13,22 @@ AKS_INFRA_RG_NAME = "AKS_INFRA_RG_NAME"
 AKS_VNET_NAME = "AKS_VNET_NAME"
 CAPZ_BASE_CONTENT_URL = "https://raw.githubusercontent.com/kubernetes-sigs/cluster-api-provider-azure/release-1.7"
 DEFAULT_CALICO_VERSION = "v3.25.1"
+
+# Environment variable and fallback value for each "az capi create" argument that has a default.
+WORKLOAD_CLUSTER_DEFAULTS = {
+    "control_plane_machine_type": ("AZURE_CONTROL_PLANE_MACHINE_TYPE", "Standard_B2s"),
+    "control_plane_machine_count": ("CONTROL_PLANE_MACHINE_COUNT", 3),
+    "node_machine_type": ("AZURE_NODE_MACHINE_TYPE", "Standard_B2s"),
+    "node_machine_count": ("WORKER_MACHINE_COUNT", 3),
+    "kubernetes_version": ("KUBERNETES_VERSION", "v1.25.3"),
+    "ssh_public_key": ("AZURE_SSH_PUBLIC_KEY", ""),
+}
+# Environment variables that must be set by the time the workload cluster template is rendered.
+WORKLOAD_CLUSTER_REQUIRED_ENV = (
+    "CLUSTER_IDENTITY_NAME",
+    "AZURE_SUBSCRIPTION_ID",
+    "AZURE_TENANT_ID",
+    "AZURE_CLIENT_ID",
+    "AZURE_CLUSTER_IDENTITY_SECRET_NAME",
+    "AZURE_CLUSTER_IDENTITY_SECRET_NAMESPACE",
+)
@@ -0,0 +1,95 @@
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+"""
+Helper functions for caching slow discovery lookups, such as release versions, on disk.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from azure.cli.core.api import get_config_dir
+
+from .logger import logger
+from .network import urlretrieve_if_modified
+from .os import write_to_file
+
+DEFAULT_TTL = 600
+
+
+def _cache_path(key, extension=".json"):
+    """Returns the cache file path for a key."""
+    digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+    return os.path.join(get_config_dir(), "capi", "cache", f"{digest}{extension}")
+
+
+def get_cached(key, ttl=DEFAULT_TTL):
+    """Returns the value cached for key if it is younger than ttl seconds, otherwise None."""
+    path = _cache_path(key)
+    try:
+        if os.stat(path).st_mtime < time.time() - ttl:
+            return None
+        with open(path, "r", encoding="utf-8") as cache_file:
+            return json.load(cache_file)["value"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def set_cached(key, value):
+    """Caches a JSON-serializable value for key. Failing to write the cache is not an error."""
+    path = _cache_path(key)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_to_file(path, json.dumps({"key": key, "value": value}))
+    except OSError as err:
+        logger.debug("Could not write discovery cache %s: %s", path, err)
+
+
+def cached(key, func, ttl=DEFAULT_TTL):
+    """Returns the cached value for key, calling func and caching its result on a miss."""
+    value = get_cached(key, ttl)
+    if value is None:
+        value = func()
+        set_cached(key, value)
+    return value
+
+
+def cached_download(url):
+    """
+    Returns the path of a local copy of url, downloading it again only if the server reports it has changed.
+    The copy is revalidated with its ETag or Last-Modified date on every call, so edits are never missed.
+    """
+    path = _cache_path(url, extension=".download")
+    validators_path = _cache_path(url, extension=".download.json")
+    validators = {}
+    if os.path.exists(path):
+        try:
+            with open(validators_path, "r", encoding="utf-8") as validators_file:
+                validators = json.load(validators_file)
+        except (OSError, ValueError):
+            pass
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Download to a unique file beside the cache entry and rename it, so concurrent or failed downloads
+    # never leave a partial copy behind.
+    descriptor, partial_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".partial")
+    os.close(descriptor)
+    try:
+        result = urlretrieve_if_modified(url, partial_path, validators.get("etag"), validators.get("last_modified"))
+        if result is None:
+            logger.debug("Using cached copy of %s", url)
+            return path
+        os.replace(partial_path, path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+    etag, last_modified = result
+    try:
+        write_to_file(validators_path, json.dumps({"url": url, "etag": etag, "last_modified": last_modified}))
+    except OSError as err:
+        logger.debug("Could not write discovery cache %s: %s", validators_path, err)
+    return path
@@ -10,23 +10,41 @@ This module contains helper functions for the az capi extension.
 import re
 import os
 
+from .constants import WORKLOAD_CLUSTER_DEFAULTS
+
+# clusterctl knows how to handle files from github/<org>/<project>
+# but not from raw files or from other domains
+_GITHUB_BLOB_RE = re.compile(r"github\.com.*blob.*$")
+
+
+_KIND_PREFIX = "kind-"
+
 
 def has_kind_prefix(inpt_str):
     """Returns bool if input has 'kind-' prefix"""
-    return inpt_str.startswith("kind-")
+    return inpt_str.startswith(_KIND_PREFIX)
 
 
-def match_output(output, regexp=None):
-    """Returns regex search result against given parameter"""
-    return re.search(regexp, output) if regexp is not None else None
+def strip_kind_prefix(inpt_str):
+    """Returns input without its 'kind-' prefix, if any"""
+    # str.removeprefix() would do this, but it needs Python 3.9.
+    return inpt_str[len(_KIND_PREFIX):] if inpt_str.startswith(_KIND_PREFIX) else inpt_str
 
 
 def is_clusterctl_compatible(template):
     """Returns true if is github file link or local file, false for links that are not github file urls"""
+    # A URL can't be a local file, so skip the stat for anything with a scheme.
+    if template.startswith(("http://", "https://")):
+        return _GITHUB_BLOB_RE.search(template)
     if os.path.isfile(template):
         return True
 
-    # clusterctl knows how to handle files from github/<org>/<project>
-    # but not from raw files or from other domains
-    reg = r"github.com(.*)blob(.*)$"
-    return match_output(template, reg)
+    return _GITHUB_BLOB_RE.search(template)
+
+
+def workload_cluster_default(name, value):
+    """Returns value if it was given, otherwise the default from the environment or the fallback value"""
+    if value is not None:
+        return value
+    env_var, fallback = WORKLOAD_CLUSTER_DEFAULTS[name]
+    return os.environ.get(env_var, fallback)
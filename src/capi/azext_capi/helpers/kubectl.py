@@ -7,6 +7,7 @@
 This module contains helper functions for the az capi extension.
 """
 
+from collections import namedtuple
 import subprocess
 import tempfile
 import os
@@ -17,12 +18,12 @@ from azure.cli.core.azclierror import UnclassifiedUserFault
 from azure.cli.core.azclierror import ResourceNotFoundError
 from azure.cli.core.azclierror import InvalidArgumentValueError
 
-from .run_command import retry_shell_command, run_shell_command
-from .os import write_to_file
-from .generic import match_output
+from .run_command import iter_shell_command_lines, retry_shell_command, run_shell_command, run_shell_command_to_file
 from .logger import logger
 from .constants import KUBECONFIG
 
+_K8S_RUNNING_RE = re.compile(r"Kubernetes .*?is running")
+
 
 def add_kubeconfig_to_command(kubeconfig=None):
     """Returns a list with kubeconfig flag"""
@@ -34,7 +35,7 @@ def find_kubectl_current_context():
     command = ["kubectl", "config", "current-context"]
     output = None
     try:
-        output = run_shell_command(command)
+        output = run_shell_command(command, capture_stderr=True)
         output = output.strip()
     except subprocess.CalledProcessError as err:
         if "current-context is not set" not in err.stdout:
@@ -96,9 +97,16 @@ def get_default_kubeconfig():
 
 def reset_current_context_and_attributes():
     """Unsets current-context and deletes context and its attributes"""
-    current_context = find_kubectl_current_context()
-    cluster_name = find_attribute_in_context(current_context, "cluster")
-    user = find_attribute_in_context(current_context, "user")
+    # Without --minify, kubectl prints an empty current-context instead of failing when none is set.
+    command = ["kubectl", "config", "view", "--output", "jsonpath={.current-context}"]
+    current_context = run_shell_command(command).strip()
+    if not current_context:
+        logger.info("No kubectl current-context to reset")
+        return
+    # Read the context's cluster and user in one kubectl call instead of two.
+    jsonpath = r'{.contexts[0].context.cluster}{"\n"}{.contexts[0].context.user}'
+    command = ["kubectl", "config", "view", "--minify", "--output", f"jsonpath={jsonpath}"]
+    cluster_name, user = (run_shell_command(command).splitlines() + ["", ""])[:2]
     delete_kubeconfig_attribute(cluster_name, "cluster")
     delete_kubeconfig_attribute(user, "user")
     delete_kubeconfig_attribute(current_context, "context")
@@ -130,33 +138,19 @@ def find_kubectl_resource_names(resource_type, error_msg, kubeconfig=None):
 def get_kubeconfig(capi_name):
     """Writes kubeconfig of specified cluster"""
     cmd = ["clusterctl", "get", "kubeconfig", capi_name]
+    filename = capi_name + ".kubeconfig"
     try:
-        mask_fields = ["certificate-authority-data", "client-certificate-data", "client-key-data"]
-        output = run_shell_command(cmd, mask_fields=mask_fields)
+        run_shell_command_to_file(cmd, filename)
     except subprocess.CalledProcessError as err:
         raise UnclassifiedUserFault("Couldn't get kubeconfig") from err
-    filename = capi_name + ".kubeconfig"
-    write_to_file(filename, output)
     return f"Wrote kubeconfig file to {filename} "
 
 
-def check_kubectl_namespace(namespace):
-    """Verifies that given namespace is active"""
-    cmd = ["kubectl", "get", "namespaces", namespace]
-    try:
-        output = run_shell_command(cmd)
-        match = match_output(output, fr"{namespace}.+?Active")
-        if match is None:
-            raise ResourceNotFoundError(f"namespace: {namespace} status is not Active")
-    except subprocess.CalledProcessError as err:
-        raise ResourceNotFoundError(f"namespace: {namespace} could not be found!") from err
-
-
 def find_default_cluster():
     """Verifies that cluster has running status"""
     cmd = ["kubectl", "cluster-info"]
     output = run_shell_command(cmd)
-    match = match_output(output, r"Kubernetes .*?is running")
+    match = _K8S_RUNNING_RE.search(output)
     if match is None:
         raise ResourceNotFoundError("No accessible Kubernetes cluster found")
     return True
@@ -173,26 +167,35 @@ def wait_for_number_of_nodes(number_of_nodes, kubeconfig=None):
     Waits for nodes of specified cluster to get be ready before proceeding.
     Timeout: 15 minutes
     """
-    command = ["kubectl", "get", "nodes", "--no-headers"]
+    # Watch the nodes so the apiserver pushes each change, rather than listing them all every few seconds.
+    # Example output:
+    #   ADDED modest-bagpiper-control-plane-ckt6r True
+    #   MODIFIED modest-bagpiper-md-0-gxb47 False
+    jsonpath = r'{.type}{" "}{.object.metadata.name}{" "}{.object.status.conditions[?(@.type=="Ready")].status}{"\n"}'
+    command = ["kubectl", "get", "nodes", "--watch", "--output-watch-events", "--output", f"jsonpath={jsonpath}"]
     command += add_kubeconfig_to_command(kubeconfig)
     timeout = 60 * 15
     error_msg = f"Not all cluster nodes are Ready after {timeout // 60} minutes."
-    start = time.time()
-    while time.time() < start + timeout:
+    deadline = time.monotonic() + timeout
+    while (remaining := deadline - time.monotonic()) > 0:
+        # Each new watch replays every current node as ADDED, so start counting from scratch.
+        ready = {}
         try:
-            output = run_shell_command(command)
+            # Keep kubectl warnings on stderr out of the parsed events.
+            for line in iter_shell_command_lines(command, timeout=remaining, combine_std=False):
+                event, name, status = (line.split() + ["", "", ""])[:3]
+                if event == "DELETED":
+                    ready.pop(name, None)
+                elif event in ("ADDED", "MODIFIED") and name:
+                    ready[name] = status == "True"
+                if sum(ready.values()) >= number_of_nodes:
+                    return
+        except subprocess.TimeoutExpired:
+            break
         except subprocess.CalledProcessError as err:
             logger.info(err)
-            time.sleep(5)
-        # Example output:
-        #   modest-bagpiper-control-plane-ckt6r   Ready      control-plane   2m31s   v1.25.3
-        #   modest-bagpiper-md-0-gxb47            NotReady   <none>          25s     v1.25.3
-        ready_nodes = sum(1 for line in output.splitlines()
-                          if (cols := line.split()) and len(cols) > 1 and cols[1] == "Ready")
-        if ready_nodes < number_of_nodes:
-            time.sleep(5)
-            continue
-        return
+        # The watch ended early, for instance if the connection dropped, so start a new one.
+        time.sleep(min(5, max(0, deadline - time.monotonic())))
     raise ResourceNotFoundError(error_msg)
 
 
@@ -201,12 +204,13 @@ def wait_for_resource_ready(find_resources, error_msg, kubeconfig=None,):
     Runs wait command from kubectl and checks for readiness of specified resources.
     Timeout: 5 minutes
     """
-    command = ["kubectl", "wait", "--for", "condition=Ready", "--timeout", "10s"]
-    command += add_kubeconfig_to_command(kubeconfig)
+    base_command = ["kubectl", "wait", "--for", "condition=Ready", "--timeout", "10s"]
+    base_command += add_kubeconfig_to_command(kubeconfig)
     timeout = 60 * 5
     start = time.time()
     while time.time() < start + timeout:
-        command += find_resources(kubeconfig)
+        # List the resources again each time, since more may have been created while waiting.
+        command = base_command + find_resources(kubeconfig)
         try:
             run_shell_command(command)
             return
@@ -231,64 +235,53 @@ def find_machines(kubeconfig=None):
     return find_kubectl_resource_names("machines", error_msg, kubeconfig)
 
 
-def check_pods_status_by_namespace(namespace, error_message, pod_name):
-    """Verifies that pod's status is running"""
-    get_pods_cmd = ["kubectl", "get", "pods"]
-    cmd = get_pods_cmd + ["--namespace", namespace]
-    try:
-        output = run_shell_command(cmd)
-        match = match_output(output, fr"No resources found in {namespace} namespace")
-        if match:
-            raise ResourceNotFoundError(error_message)
-        match = match_output(output, fr"{pod_name}-.+?Running")
-        if match is None:
-            raise ResourceNotFoundError(f"No pods running in {namespace} namespace")
-    except subprocess.CalledProcessError as err:
-        cmd = get_pods_cmd + ["-A", namespace]
-        try:
-            output = run_shell_command(cmd)
-            logger.debug(output)
-        except subprocess.CalledProcessError as sub_err:
-            logger.error(sub_err)
-        logger.error(err)
-        raise
+def get_provider_pods():
+    """Returns (namespace, name, phase) tuples for the pods of installed Cluster API providers"""
+    # clusterctl labels every provider component with cluster.x-k8s.io/provider.
+    jsonpath = r'{range .items[*]}{.metadata.namespace}{" "}{.metadata.name}{" "}{.status.phase}{"\n"}{end}'
+    command = ["kubectl", "get", "pods", "--all-namespaces", "--selector", "cluster.x-k8s.io/provider",
+               "--output", f"jsonpath={jsonpath}"]
+    output = run_shell_command(command)
+    return [tuple(fields) for fields in (line.split() for line in output.splitlines()) if len(fields) == 3]
 
 
-def get_azure_cluster(cluster_name, kubeconfig=None):
-    """Returns AzureCluster Object"""
-    command = ["kubectl", "get", "AzureCluster", cluster_name, "-o", "json"]
+def wait_for_provider_pods(timeout):
+    """Waits up to timeout seconds for the pods of installed Cluster API providers to be Ready"""
+    command = ["kubectl", "wait", "pods", "--all-namespaces", "--selector", "cluster.x-k8s.io/provider",
+               "--for", "condition=Ready", "--timeout", f"{int(timeout)}s"]
+    run_shell_command(command)
+
+
+AzureClusterInfo = namedtuple("AzureClusterInfo", ["resource_group", "host", "port"])
+
+
+def get_azure_cluster_info(cluster_name, kubeconfig=None):
+    """Returns the resource group and control plane endpoint of an AzureCluster"""
+    # Ask kubectl for just the fields we need rather than parsing the whole object.
+    jsonpath = r'{.spec.resourceGroup}{"\n"}{.spec.controlPlaneEndpoint.host}{"\n"}{.spec.controlPlaneEndpoint.port}'
+    command = ["kubectl", "get", "AzureCluster", cluster_name, "--output", f"jsonpath={jsonpath}"]
     command += add_kubeconfig_to_command(kubeconfig)
     try:
-        return run_shell_command(command)
+        output = run_shell_command(command)
     except subprocess.CalledProcessError as err:
         raise InvalidArgumentValueError(f"Could not find {cluster_name}") from err
+    resource_group, host, port = (output.splitlines() + ["", "", ""])[:3]
+    return AzureClusterInfo(resource_group.strip(), host.strip().lower(), int(port) if port.strip() else None)
 
 
-def get_kubectl_cluster_info(kubeconfig=None):
-    """Returns kubectl cluster-info result"""
-    command = ["kubectl", "cluster-info"]
+def get_current_server(kubeconfig=None):
+    """Returns the API server URL of the current context"""
+    command = ["kubectl", "config", "view", "--minify", "--output", "jsonpath={.clusters[0].cluster.server}"]
     command += add_kubeconfig_to_command(kubeconfig)
-    return run_shell_command(command)
-
-
-def get_ports_cluster(kubeconfig=None):
-    """Returns dictionary with cluster component ports"""
-    output = get_kubectl_cluster_info(kubeconfig)
-    match = re.findall(r"(?<=is running at )[^\s]{1,}", output)
-    result = {
-        "control_plane": match[0],
-        "coredns": match[1]
-    }
-    return result
+    return run_shell_command(command).strip()
 
 
 def get_configmap(kubeconfig, name, namespace):
     """Returns the specified Kubernetes configmap as a YAML string."""
-    attempts, delay, output = 100, 3, ""
     command = ["kubectl", "get", "configmap", name, "--namespace", namespace, "-o", "yaml", "--kubeconfig", kubeconfig]
     try:
-        output = retry_shell_command(command, attempts, delay)
-    except subprocess.CalledProcessError as err:
+        output = retry_shell_command(command)
+    except subprocess.SubprocessError as err:
         raise ResourceNotFoundError(f"Couldn't find configmap {name} in namespace {namespace}") from err
     return output
 
@@ -298,10 +291,42 @@ def create_configmap(kubeconfig, data):
     with tempfile.NamedTemporaryFile(mode="w") as temp_file:
         temp_file.write(data)
         temp_file.flush()
-        attempts, delay, output = 100, 3, ""
         command = ["kubectl", "create", "-f", temp_file.name, "--kubeconfig", kubeconfig]
         try:
-            output = retry_shell_command(command, attempts, delay)
-        except subprocess.CalledProcessError as err:
+            output = retry_shell_command(command)
+        except subprocess.SubprocessError as err:
             raise ResourceNotFoundError("Couldn't create configmap") from err
         return output
+
+
+# kubectl apply failures that retrying won't fix, such as a malformed, invalid, or missing manifest.
+# Errors like "no matches for kind" are expected while CRDs are still being installed, so they are retried.
+_PERMANENT_APPLY_ERROR_RE = re.compile(
+    r"error parsing"
+    r"|error converting YAML to JSON"
+    r'|the path ".*?" does not exist'
+    r"|is invalid:"
+)
+
+
+_KUBECTL_ERROR_LINE_RE = re.compile(r"^(?:Error from server|error:).*$", re.MULTILINE)
+
+
+def run_kubectl_apply(command, timeout=None):
+    """
+    Run kubectl apply, treating a failure where every error is AlreadyExists as success.
+    Failures that retrying won't fix are raised as SubprocessError rather than CalledProcessError.
+    """
+    try:
+        # Capture stderr even with --verbose, since that's where kubectl reports errors.
+        return run_shell_command(command, timeout=timeout, capture_stderr=True)
+    except subprocess.CalledProcessError as err:
+        output = err.output or ""
+        # A racing create of the same objects leaves them in the desired state, so there's nothing to retry.
+        errors = _KUBECTL_ERROR_LINE_RE.findall(output)
+        if errors and all("(AlreadyExists)" in line for line in errors):
+            logger.info("Ignoring AlreadyExists errors from %s", " ".join(command))
+            return err.output
+        if _PERMANENT_APPLY_ERROR_RE.search(output):
+            raise subprocess.SubprocessError(output) from err
+        raise
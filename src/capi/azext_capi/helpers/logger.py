@@ -18,3 +18,9 @@ logger = get_logger()  # pylint: disable=invalid-name
 def is_verbose():
     """Return True if any logger handler has a level less than logging.INFO."""
     return any(handler.level <= logging.INFO for handler in logger.handlers)
+
+
+@lru_cache(maxsize=None)
+def is_debug():
+    """Return True if any logger handler has a level less than or equal to logging.DEBUG."""
+    return any(handler.level <= logging.DEBUG for handler in logger.handlers)
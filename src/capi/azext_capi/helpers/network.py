@@ -6,12 +6,17 @@
 """
 This module contains helper functions for the az capi extension.
 """
+from functools import lru_cache
 from urllib.parse import urlparse
+import shutil
 import ssl
 
-from six.moves.urllib.request import urlopen
+from six.moves.urllib.error import HTTPError
+from six.moves.urllib.request import Request, urlopen
 
 
+# Creating a context loads the system CA store, so share one across all downloads.
+@lru_cache(maxsize=1)
 def ssl_context():
     """Returns an SSL context appropriate for the python version and environment."""
     context = ssl.create_default_context()
@@ -21,9 +26,29 @@ def ssl_context():
 
 def urlretrieve(url, filename):
     """Retrieves the contents of a URL to a file."""
-    req = urlopen(url, context=ssl_context())  # pylint: disable=consider-using-with
-    with open(filename, "wb") as out:
-        out.write(req.read())
+    # Stream in chunks so large binaries like kubectl are never held in memory all at once.
+    with urlopen(url, context=ssl_context()) as req, open(filename, "wb") as out:
+        shutil.copyfileobj(req, out, 1 << 20)
+
+
+def urlretrieve_if_modified(url, filename, etag=None, last_modified=None):
+    """
+    Retrieves the contents of a URL to a file, unless the server reports it still matches etag or last_modified.
+    Returns the (etag, last_modified) validators of the new contents, or None if the contents were not modified.
+    """
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    try:
+        with urlopen(Request(url, headers=headers), context=ssl_context()) as req, open(filename, "wb") as out:
+            shutil.copyfileobj(req, out, 1 << 20)
+            return req.headers.get("ETag"), req.headers.get("Last-Modified")
+    except HTTPError as err:
+        if err.code == 304:
+            return None
+        raise
 
 
 def get_url_domain_name(url):
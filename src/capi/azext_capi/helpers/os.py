@@ -8,7 +8,11 @@ Helper functions for working with the environment, files, and other operating sy
 """
 
 import os
-import yaml
+import tempfile
+
+# The umask can only be read by setting it, so do that once at import, before any threads are started.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
 
 
 def set_environment_variables(dic=None):
@@ -24,15 +28,29 @@ def set_environment_variables(dic=None):
 
 def write_to_file(filename, file_input):
     """
-    Writes file_input into file
+    Writes file_input into file, replacing it atomically so it is never left partially written
     """
-    descriptor = os.open(path=filename, flags=os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode=0o600)
-    with open(descriptor, "w", encoding="utf-8") as manifest_file:
-        manifest_file.write(file_input)
+    # mkstemp creates the file with mode 0600, so give it the mode the target has or would be created with.
+    try:
+        mode = os.stat(filename).st_mode & 0o7777
+    except FileNotFoundError:
+        mode = 0o666 & ~_UMASK
+    descriptor, temp_filename = tempfile.mkstemp(dir=os.path.dirname(filename) or ".",
+                                                 prefix=f".{os.path.basename(filename)}.")
+    try:
+        with open(descriptor, "w", encoding="utf-8") as manifest_file:
+            manifest_file.write(file_input)
+        os.chmod(temp_filename, mode)
+        os.replace(temp_filename, filename)
+    except OSError:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
 
 
 def prep_kube_config():
     """Prepares kubeconfig file for safe use with the "az aks get-credentials" command."""
+    import yaml  # pylint: disable=import-outside-toplevel
     if "KUBECONFIG" in os.environ:
         kubeconfig_path = os.environ["KUBECONFIG"].split(os.pathsep)[0]
     else:
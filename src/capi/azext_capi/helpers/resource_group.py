@@ -0,0 +1,29 @@
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+"""
+This module contains Azure resource group helper functions for the az capi extension.
+"""
+
+from azure.cli.core.azclierror import UnclassifiedUserFault
+
+from .run_command import message_variants
+from .spinner import Spinner
+
+
+def delete_resource_group(cmd, resource_group, spinner_msg, no_wait=False):
+    """Delete a resource group through the SDK client already loaded in this process, instead of forking az."""
+    # pylint: disable=import-outside-toplevel
+    from azure.core.exceptions import HttpResponseError
+    from .._client_factory import cf_resource_groups
+
+    begin_msg, end_msg, err_msg = message_variants(spinner_msg)
+    with Spinner(cmd, begin_msg, end_msg):
+        try:
+            poller = cf_resource_groups(cmd.cli_ctx).begin_delete(resource_group)
+            if not no_wait:
+                poller.result()
+        except HttpResponseError as err:
+            raise UnclassifiedUserFault(err_msg) from err
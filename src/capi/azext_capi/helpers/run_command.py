@@ -5,7 +5,11 @@
 
 # pylint: disable=missing-docstring
 
+import os
+import random
 import subprocess
+import tempfile
+import threading
 import time
 
 from azure.cli.core.azclierror import UnclassifiedUserFault
@@ -14,30 +18,98 @@ from .spinner import Spinner
 from .logger import logger, is_verbose
 
 
-def run_shell_command(command, combine_std=True, mask_fields=None):
-    # if --verbose, don't capture stderr
+def run_shell_command(command, combine_std=True, mask_fields=None, timeout=None, capture_stderr=False):
+    # if --verbose, don't capture stderr unless the caller needs to inspect it
     stderr = None
     if combine_std:
-        stderr = None if is_verbose() else subprocess.STDOUT
-    output = subprocess.check_output(command, universal_newlines=True, stderr=stderr)
-    log_output = mask(output, mask_fields)
-    logger.info("%s returned:\n%s", " ".join(command), log_output)
+        stderr = subprocess.STDOUT if capture_stderr or not is_verbose() else None
+    try:
+        output = subprocess.check_output(command, text=True, stderr=stderr, timeout=timeout)
+    except subprocess.CalledProcessError as err:
+        # Captured stderr isn't shown as the command runs, so show it here instead.
+        if capture_stderr and is_verbose():
+            logger.info("%s failed:\n%s", " ".join(command), mask(err.output or "", mask_fields))
+        raise
+    # Only mask and format the output if a handler will actually show it.
+    if is_verbose():
+        logger.info("%s returned:\n%s", " ".join(command), mask(output, mask_fields))
     return output
 
 
-def mask(output, mask_fields):
-    """Mask all instances of mask_fields with "****" in JSON or YAML output."""
-    if mask_fields and output:
-        for field in mask_fields:
-            output = mask_field(output, field)
-    return output
+def iter_shell_command_lines(command, timeout=None, combine_std=True):
+    """
+    Run a shell command, yielding each line of its output as soon as it is read.
+    If timeout is given, the command is killed after that many seconds and TimeoutExpired is raised.
+    If combine_std is False, stderr is kept out of the yielded lines and logged once the command ends.
+    """
+    stderr_file = None
+    if combine_std:
+        # if --verbose, don't capture stderr
+        stderr = None if is_verbose() else subprocess.STDOUT
+    else:
+        # Spool stderr to a file rather than a pipe, so a chatty command can't block on a full pipe.
+        stderr = stderr_file = tempfile.TemporaryFile(mode="w+")
+    expired = threading.Event()
+    try:
+        with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr, text=True, bufsize=1) as proc:
+            def expire():
+                expired.set()
+                proc.kill()
+
+            timer = threading.Timer(timeout, expire) if timeout is not None else None
+            if timer:
+                timer.daemon = True
+                timer.start()
+            try:
+                for line in proc.stdout:
+                    yield line.rstrip("\n")
+            finally:
+                if timer:
+                    timer.cancel()
+                # Don't wait on a long-running command, such as a watch, if the caller stopped reading early.
+                if proc.poll() is None:
+                    proc.kill()
+    finally:
+        if stderr_file:
+            stderr_file.seek(0)
+            errors = stderr_file.read().strip()
+            stderr_file.close()
+            if errors:
+                logger.info("%s stderr:\n%s", " ".join(command), errors)
+    if expired.is_set():
+        raise subprocess.TimeoutExpired(command, timeout)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, command)
+
+
+def run_shell_command_to_file(command, filename):
+    """
+    Run a shell command, streaming its standard output into a file readable only by the user.
+    The file is only replaced once the command succeeds, so a failure leaves any existing file untouched.
+    """
+    # mkstemp creates the file with mode 0600, next to the target so os.replace can't cross filesystems.
+    descriptor, temp_name = tempfile.mkstemp(dir=os.path.dirname(filename) or ".",
+                                             prefix=f".{os.path.basename(filename)}.")
+    try:
+        with open(descriptor, "wb") as out_file:
+            subprocess.run(command, stdout=out_file, stderr=subprocess.PIPE, check=True, text=True)
+        os.replace(temp_name, filename)
+    except BaseException:
+        os.remove(temp_name)
+        raise
+    logger.info("%s output written to %s", " ".join(command), filename)
 
 
-def mask_field(output, key):
-    """Mask all instances of key with "****" in JSON or YAML output."""
+def mask(output, mask_fields):
+    """Mask all instances of mask_fields with "****" in JSON or YAML output."""
+    if not (mask_fields and output):
+        return output
+    # Check every line against all fields in one pass, rather than one pass over the output per field.
+    mask_fields = set(mask_fields)
     lines = []
     for line in output.splitlines():
-        if line.strip().replace('"', '').startswith(key + ": "):
+        key, sep, _ = line.strip().replace('"', '').partition(": ")
+        if sep and key in mask_fields:
             maybe_comma = "," if line.endswith(",") else ""
             lines.append(line.split(": ")[0] + ': "****"' + maybe_comma)
         else:
@@ -45,6 +117,11 @@ def mask_field(output, key):
     return "\n".join(lines)
 
 
+def mask_field(output, key):
+    """Mask all instances of key with "****" in JSON or YAML output."""
+    return mask(output, [key])
+
+
 def message_variants(template_msg):
     # Find the first word and assume it's a capitalized verb.
     verb, predicate = template_msg.split(" ", 1)
@@ -65,16 +142,37 @@ def try_command_with_spinner(cmd, command, spinner_msg, include_error_stdout=Fal
             raise UnclassifiedUserFault(err_msg) from err
 
 
-def retry_shell_command(command, attempts=100, delay=3):
-    """Run a shell command, retrying a number of times with a specified delay if it fails."""
-    output = ""
-    for i in range(attempts):
+def backoff_delay(attempt, initial=0.25, cap=3.0, jitter=0.25):
+    """Return seconds to wait before a zero-based retry attempt: capped exponential backoff plus random jitter."""
+    return min(cap, initial * 2 ** attempt) + random.uniform(0, jitter)
+
+
+def retry_with_backoff(func, total_timeout=300, initial=0.25, cap=3.0, exceptions=(subprocess.CalledProcessError,)):
+    """Call func until it stops raising one of exceptions, backing off for up to total_timeout seconds."""
+    deadline = time.monotonic() + total_timeout
+    attempt = 0
+    while True:
         try:
-            output = run_shell_command(command)
-            break
-        except subprocess.CalledProcessError as err:
+            return func()
+        except exceptions as err:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise
             logger.info(err)
-            if i == attempts - 1:
+            time.sleep(min(remaining, backoff_delay(attempt, initial, cap)))
+            attempt += 1
+
+
+def retry_shell_command(command, timeout=300, delay=3):
+    """Run a shell command, retrying with a fixed delay until it succeeds or timeout seconds have passed."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            # Kill a hung command rather than let it outlive the retry budget.
+            return run_shell_command(command, timeout=max(1, deadline - time.monotonic()))
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as err:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
                 raise
-            time.sleep(delay)
-    return output
+            logger.info(err)
+            time.sleep(min(delay, remaining))
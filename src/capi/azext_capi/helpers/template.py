@@ -0,0 +1,95 @@
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+"""
+This module renders workload cluster templates and addon manifests for the az capi extension.
+"""
+
+from functools import lru_cache
+import re
+import subprocess
+
+from azure.cli.core.azclierror import RequiredArgumentMissingError
+
+from .constants import CAPZ_BASE_CONTENT_URL
+from .discovery_cache import cached_download
+from .generic import is_clusterctl_compatible
+from .logger import is_debug, logger
+from .os import set_environment_variables, write_to_file
+from .run_command import run_shell_command
+
+
+@lru_cache(maxsize=1)
+def _jinja_env():
+    """Return the Jinja environment for the built-in templates, which doesn't change during a command."""
+    from jinja2 import Environment, PackageLoader, StrictUndefined  # pylint: disable=import-outside-toplevel
+    return Environment(loader=PackageLoader("azext_capi", "templates"),
+                       auto_reload=False, undefined=StrictUndefined)
+
+
+@lru_cache(maxsize=None)
+def _base_template():
+    """Return the compiled built-in workload cluster template."""
+    return _jinja_env().get_template("base.jinja")
+
+
+def render_builtin_jinja_template(args):
+    """Use the built-in template and process it with Jinja."""
+    from jinja2.exceptions import UndefinedError  # pylint: disable=import-outside-toplevel
+    if is_debug():
+        logger.debug("Available templates: %s", _jinja_env().list_templates())
+    try:
+        return _base_template().render(args)
+    except UndefinedError as err:
+        msg = f"Could not generate workload cluster configuration.\n{err}"
+        raise RequiredArgumentMissingError(msg) from err
+
+
+# clusterctl lists missing variables in brackets, e.g. "value for variables [AZURE_LOCATION] is not set"
+_CLUSTERCTL_MISSING_VARS_RE = re.compile(r"\[([^\]]+)\]")
+
+
+def render_custom_cluster_template(template, args=None):
+    """Fetch a user-defined template and process it with "clusterctl generate"."""
+    set_environment_variables(args)
+    command = ["clusterctl", "generate", "yaml", "--from"]
+    if not is_clusterctl_compatible(template):
+        # download file so clusterctl can use a local file
+        template = cached_download(template)
+    command += [template]
+    try:
+        return run_shell_command(command)
+    except subprocess.CalledProcessError as err:
+        msg = "Could not generate workload cluster configuration."
+        err_command_list = err.args[1]
+        err_command_name = err_command_list[0]
+        if err_command_name == "clusterctl":
+            match = _CLUSTERCTL_MISSING_VARS_RE.search(err.stdout or "")
+            error_variables = match.group(1) if match else "<unknown>"
+            msg += f"\nPlease set the following environment variables:\n{error_variables}"
+        raise RequiredArgumentMissingError(msg) from err
+
+
+def render_windows_proxy_manifests(kpng=False):
+    """
+    Render the Windows kube-proxy (or kpng) manifests to files and return the filenames in apply order.
+    The template variables must already be set in the environment.
+    """
+    if not kpng:
+        manifests = [
+            (f"{CAPZ_BASE_CONTENT_URL}/templates/addons/windows/calico/kube-proxy-windows.yaml",
+             "kube-proxy-windows.yaml"),
+        ]
+    else:
+        manifests = [
+            ("https://raw.githubusercontent.com/kubernetes-sigs/windows-service-proxy/main/deploy/kpng-rbac.yaml",
+             "kpng-rback.yaml"),
+            ("https://raw.githubusercontent.com/kubernetes-sigs/windows-service-proxy/main/deploy/kpng-windows-capz-calico.yaml",  # pylint: disable=line-too-long
+             "kpng.yaml"),
+        ]
+    for manifest_url, manifest_file in manifests:
+        manifest = render_custom_cluster_template(manifest_url)
+        write_to_file(manifest_file, manifest)
+    return [manifest_file for _, manifest_file in manifests]
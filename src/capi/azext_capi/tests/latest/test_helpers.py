@@ -3,6 +3,7 @@
 # Licensed under the MIT License. See License.txt in the project root for license information.
 # --------------------------------------------------------------------------------------------
 
+import io
 import subprocess
 import os
 import sys
@@ -16,15 +17,16 @@ from azure.cli.core.azclierror import UnclassifiedUserFault
 from azure.cli.core.azclierror import InvalidArgumentValueError
 from azure.cli.core.azclierror import ResourceNotFoundError
 
+import azext_capi.helpers.discovery_cache as discovery_cache
 import azext_capi.helpers.network as network
 import azext_capi.helpers.generic as generic
-from azext_capi.custom import create_resource_group, create_new_management_cluster, management_cluster_components_missing_matching_expressions, get_default_bootstrap_commands, parse_bootstrap_commands_from_file
+from azext_capi.custom import create_resource_group, create_new_management_cluster, find_management_cluster, get_azure_cluster_info, is_self_managed_cluster, management_cluster_components_missing_matching_expressions, get_default_bootstrap_commands, parse_bootstrap_commands_from_file
 from azext_capi.helpers.binary import get_arch
 from azext_capi.helpers.prompt import get_user_prompt_or_default
-from azext_capi.helpers.kubectl import check_kubectl_namespace, find_attribute_in_context, find_kubectl_current_context, find_default_cluster, add_kubeconfig_to_command
+from azext_capi.helpers.kubectl import AzureClusterInfo, find_attribute_in_context, find_kubectl_current_context, find_default_cluster, add_kubeconfig_to_command, reset_current_context_and_attributes, wait_for_number_of_nodes
 from azext_capi.helpers.names import generate_cluster_name
-from azext_capi.helpers.os import prep_kube_config
-from azext_capi.helpers.run_command import mask, message_variants, run_shell_command, try_command_with_spinner
+from azext_capi.helpers.os import prep_kube_config, write_to_file
+from azext_capi.helpers.run_command import mask, message_variants, retry_shell_command, retry_with_backoff, run_shell_command, run_shell_command_to_file, try_command_with_spinner
 
 
 class TestSSLContextHelper(unittest.TestCase):
@@ -59,8 +61,7 @@ class TestURLRetrieveHelper(unittest.TestCase):
     @patch('azext_capi.helpers.network.urlopen')
     def test_urlretrieve(self, mock_urlopen):
         random_bytes = os.urandom(2048)
-        req = mock_urlopen.return_value
-        req.read.return_value = random_bytes
+        mock_urlopen.return_value.__enter__.return_value = io.BytesIO(random_bytes)
         with tempfile.NamedTemporaryFile(delete=False) as fp:
             fp.close()
             network.urlretrieve('https://dummy.url', fp.name)
@@ -72,10 +73,6 @@ class FindDefaultCluster(unittest.TestCase):
 
     def setUp(self):
         self.cmd = Mock()
-        self.match_output_patch = patch('azext_capi.helpers.kubectl.match_output')
-        self.match_output_mock = self.match_output_patch.start()
-        self.match_output_mock.return_value = None
-        self.addCleanup(self.match_output_patch.stop)
 
         self.run_shell_command_patch = patch('azext_capi.helpers.kubectl.run_shell_command')
         self.run_shell_command_mock = self.run_shell_command_patch.start()
@@ -83,10 +80,8 @@ class FindDefaultCluster(unittest.TestCase):
 
     # Test kubernetes cluster is found and running
     def test_found_k8s_cluster_running_state(self):
-        self.run_shell_command_mock.return_value = "fake_return"
-        self.match_output_mock.return_value = Mock()
+        self.run_shell_command_mock.return_value = "Kubernetes control plane is running at https://127.0.0.1:6443"
         result = find_default_cluster()
-        self.match_output_mock.assert_called_once()
         self.assertTrue(result)
 
     # Test kubernetes cluster is found but not running state matched
@@ -156,6 +151,93 @@ class RunShellMethod(unittest.TestCase):
         with self.assertRaises(FileNotFoundError):
             run_shell_command(self.command)
 
+    # Test stderr is captured with --verbose when asked for
+    @patch('azext_capi.helpers.run_command.is_verbose', return_value=True)
+    @patch('subprocess.check_output')
+    def test_capture_stderr_when_verbose(self, check_out_mock, _):
+        run_shell_command(self.command, capture_stderr=True)
+        self.assertEqual(check_out_mock.call_args[1]["stderr"], subprocess.STDOUT)
+        run_shell_command(self.command)
+        self.assertIsNone(check_out_mock.call_args[1]["stderr"])
+
+
+class RunShellCommandToFile(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.filename = os.path.join(self.temp_dir.name, "kubeconfig")
+        with open(self.filename, "w", encoding="utf-8") as file:
+            file.write("old")
+
+    def test_replaces_file_on_success(self):
+        run_shell_command_to_file([sys.executable, "-c", "print('new')"], self.filename)
+        with open(self.filename, encoding="utf-8") as file:
+            self.assertEqual(file.read().strip(), "new")
+        self.assertEqual(os.listdir(self.temp_dir.name), ["kubeconfig"])
+
+    def test_keeps_file_on_failure(self):
+        with self.assertRaises(subprocess.CalledProcessError):
+            run_shell_command_to_file([sys.executable, "-c", "import sys; sys.exit(1)"], self.filename)
+        with open(self.filename, encoding="utf-8") as file:
+            self.assertEqual(file.read(), "old")
+        self.assertEqual(os.listdir(self.temp_dir.name), ["kubeconfig"])
+
+
+class RetryWithBackoff(unittest.TestCase):
+
+    def setUp(self):
+        self.sleep_patch = patch('time.sleep')
+        self.sleep_mock = self.sleep_patch.start()
+        self.addCleanup(self.sleep_patch.stop)
+        self.error = subprocess.CalledProcessError(1, ["fake-command"])
+
+    def test_returns_after_retries(self):
+        func = Mock(side_effect=[self.error, self.error, "done"])
+        self.assertEqual(retry_with_backoff(func), "done")
+        self.assertEqual(func.call_count, 3)
+        first, second = (c[0][0] for c in self.sleep_mock.call_args_list)
+        self.assertTrue(0.25 <= first <= 0.5)
+        self.assertTrue(0.5 <= second <= 0.75)
+
+    def test_raises_after_timeout(self):
+        func = Mock(side_effect=self.error)
+        with self.assertRaises(subprocess.CalledProcessError):
+            retry_with_backoff(func, total_timeout=0)
+        func.assert_called_once()
+        self.sleep_mock.assert_not_called()
+
+    def test_other_exceptions_are_not_retried(self):
+        func = Mock(side_effect=ValueError)
+        with self.assertRaises(ValueError):
+            retry_with_backoff(func)
+        func.assert_called_once()
+
+
+class RetryShellCommand(unittest.TestCase):
+
+    def setUp(self):
+        self.sleep_patch = patch('time.sleep')
+        self.sleep_mock = self.sleep_patch.start()
+        self.addCleanup(self.sleep_patch.stop)
+        self.run_shell_patch = patch('azext_capi.helpers.run_command.run_shell_command')
+        self.run_shell_mock = self.run_shell_patch.start()
+        self.addCleanup(self.run_shell_patch.stop)
+
+    def test_retries_timed_out_command(self):
+        self.run_shell_mock.side_effect = [subprocess.TimeoutExpired(["fake-command"], 1), "done"]
+        self.assertEqual(retry_shell_command(["fake-command"]), "done")
+        self.assertEqual(self.run_shell_mock.call_count, 2)
+        self.assertTrue(0 < self.run_shell_mock.call_args_list[0][1]["timeout"] <= 300)
+        self.sleep_mock.assert_called_once_with(3)
+
+    def test_raises_after_timeout(self):
+        self.run_shell_mock.side_effect = subprocess.CalledProcessError(1, ["fake-command"])
+        with self.assertRaises(subprocess.CalledProcessError):
+            retry_shell_command(["fake-command"], timeout=0)
+        self.run_shell_mock.assert_called_once()
+        self.sleep_mock.assert_not_called()
+
 
 class FindKubectlCurrentContext(unittest.TestCase):
 
@@ -212,6 +294,42 @@ class FindAttributeInContext(unittest.TestCase):
         self.assertIsNone(result)
 
 
+class ResetCurrentContextAndAttributes(unittest.TestCase):
+
+    def setUp(self):
+        self.run_shell_patch = patch('azext_capi.helpers.kubectl.run_shell_command')
+        self.run_shell_mock = self.run_shell_patch.start()
+        self.addCleanup(self.run_shell_patch.stop)
+
+    def test_deletes_current_context_attributes(self):
+        self.run_shell_mock.side_effect = ["context-fake\n", "cluster-fake\nuser-fake", None, None, None, None]
+        reset_current_context_and_attributes()
+        commands = [c[0][0] for c in self.run_shell_mock.call_args_list]
+        self.assertEqual(commands[0][:3], ["kubectl", "config", "view"])
+        self.assertEqual(commands[1][:4], ["kubectl", "config", "view", "--minify"])
+        self.assertEqual(commands[2:], [
+            ["kubectl", "config", "delete-cluster", "cluster-fake"],
+            ["kubectl", "config", "delete-user", "user-fake"],
+            ["kubectl", "config", "delete-context", "context-fake"],
+            ["kubectl", "config", "unset", "current-context"],
+        ])
+
+    def test_no_current_context(self):
+        self.run_shell_mock.return_value = ""
+        reset_current_context_and_attributes()
+        self.run_shell_mock.assert_called_once()
+
+
+class ResetCurrentContextAndAttributesVerbose(unittest.TestCase):
+
+    # Test no current-context is detected without the error text, which --verbose doesn't capture
+    @patch('azext_capi.helpers.run_command.is_verbose', return_value=True)
+    @patch('subprocess.check_output', return_value="")
+    def test_no_current_context_when_verbose(self, check_out_mock, _):
+        reset_current_context_and_attributes()
+        check_out_mock.assert_called_once()
+
+
 class CreateResourceGroup(unittest.TestCase):
 
     def setUp(self):
@@ -324,40 +442,139 @@ class TryCommandWithSpinner(unittest.TestCase):
                 self.assertEquals(message_variants(case.template), (case.begin, case.end, case.error))
 
 
-class CheckKubectlNamespaceTest(unittest.TestCase):
+class WaitForNumberOfNodesTest(unittest.TestCase):
 
     def setUp(self):
-        self.namespace = "fake"
-        self.command = ["fake-command"]
+        self.iter_lines_patch = patch('azext_capi.helpers.kubectl.iter_shell_command_lines')
+        self.iter_lines_mock = self.iter_lines_patch.start()
+        self.addCleanup(self.iter_lines_patch.stop)
+        self.sleep_patch = patch('time.sleep')
+        self.sleep_patch.start()
+        self.addCleanup(self.sleep_patch.stop)
+
+    def test_returns_when_enough_nodes_ready(self):
+        self.iter_lines_mock.return_value = iter([
+            "ADDED node-a True",
+            "ADDED node-b False",
+            "MODIFIED node-b True",
+            "MODIFIED node-c False",
+        ])
+        self.assertIsNone(wait_for_number_of_nodes(2))
+        self.assertEqual(self.iter_lines_mock.call_count, 1)
+        command = self.iter_lines_mock.call_args[0][0]
+        self.assertIn("--watch", command)
+
+    def test_deleted_node_is_not_counted(self):
+        self.iter_lines_mock.side_effect = [
+            iter(["ADDED node-a True", "DELETED node-a True"]),
+            iter(["ADDED node-b True", "ADDED node-c True"]),
+        ]
+        self.assertIsNone(wait_for_number_of_nodes(2))
+        self.assertEqual(self.iter_lines_mock.call_count, 2)
+
+    def test_restarted_watch_starts_counting_again(self):
+        self.iter_lines_mock.side_effect = [
+            iter(["ADDED node-a True"]),
+            iter(["ADDED node-b True"]),
+            iter(["ADDED node-b True", "ADDED node-c True"]),
+        ]
+        self.assertIsNone(wait_for_number_of_nodes(2))
+        self.assertEqual(self.iter_lines_mock.call_count, 3)
+
+    def test_ignores_non_event_lines(self):
+        self.iter_lines_mock.return_value = iter([
+            "W1016 10:00:00.000000 1234 warnings.go:70] fake warning",
+            "ADDED node-a True",
+        ])
+        self.assertIsNone(wait_for_number_of_nodes(1))
+        self.assertFalse(self.iter_lines_mock.call_args[1]["combine_std"])
+
+    def test_timeout(self):
+        self.iter_lines_mock.side_effect = subprocess.TimeoutExpired("kubectl", 900)
+        with self.assertRaises(ResourceNotFoundError):
+            wait_for_number_of_nodes(1)
 
-        self.run_shell_command_patch = patch('azext_capi.helpers.kubectl.run_shell_command')
-        self.run_shell_command_mock = self.run_shell_command_patch.start()
-        self.addCleanup(self.run_shell_command_patch.stop)
 
-        self.match_output_patch = patch('azext_capi.helpers.kubectl.match_output')
-        self.match_output_mock = self.match_output_patch.start()
-        self.addCleanup(self.match_output_patch.stop)
+class FindManagementClusterTest(unittest.TestCase):
 
-    def test_no_existing_namespace(self):
-        error_msg = f"namespace: {self.namespace} could not be found!"
-        error_side_effect = subprocess.CalledProcessError(2, self.command, output=error_msg)
-        self.run_shell_command_mock.side_effect = error_side_effect
+    RunningPods = [
+        ("capz-system", "capz-controller-manager-7c8b6b6c4-9xk2d", "Running"),
+        ("capi-system", "capi-controller-manager-5f4d8b6c7d-x2x7k", "Running"),
+        ("capi-kubeadm-bootstrap-system", "capi-kubeadm-bootstrap-controller-manager-6c9b8f-4m2pq", "Running"),
+        ("capi-kubeadm-control-plane-system", "capi-kubeadm-control-plane-controller-manager-84d5-7wq9s", "Running"),
+    ]
+
+    def setUp(self):
+        self.get_provider_pods_patch = patch('azext_capi.helpers.kubectl.get_provider_pods')
+        self.get_provider_pods_mock = self.get_provider_pods_patch.start()
+        self.addCleanup(self.get_provider_pods_patch.stop)
+
+    def test_all_components_running(self):
+        self.get_provider_pods_mock.return_value = self.RunningPods
+        self.assertIsNone(find_management_cluster())
+        self.get_provider_pods_mock.assert_called_once()
+
+    def test_missing_component(self):
+        self.get_provider_pods_mock.return_value = self.RunningPods[1:]
         with self.assertRaises(ResourceNotFoundError) as cm:
-            check_kubectl_namespace(self.namespace)
-        self.assertEquals(cm.exception.error_msg, error_msg)
+            find_management_cluster()
+        self.assertEqual(cm.exception.error_msg, "No CAPZ installation found")
 
-    def test_no_active_namespace(self):
-        self.run_shell_command_mock.return_value = f"{self.namespace} FakeStatus FakeAge"
-        self.match_output_mock.return_value = None
+    def test_component_not_running(self):
+        pods = list(self.RunningPods)
+        pods[1] = ("capi-system", "capi-controller-manager-5f4d8b6c7d-x2x7k", "Pending")
+        self.get_provider_pods_mock.return_value = pods
         with self.assertRaises(ResourceNotFoundError) as cm:
-            check_kubectl_namespace(self.namespace)
-        self.assertEquals(cm.exception.error_msg, f"namespace: {self.namespace} status is not Active")
+            find_management_cluster()
+        self.assertEqual(cm.exception.error_msg, "No pods running in capi-system namespace")
+
+    def test_unreachable_cluster(self):
+        self.get_provider_pods_mock.side_effect = subprocess.CalledProcessError(1, ["kubectl"])
+        with self.assertRaises(subprocess.CalledProcessError):
+            find_management_cluster()
+
 
-    def test_existing_namespace(self):
-        self.run_shell_command_mock.return_value = f"{self.namespace} Active FakeAge"
-        self.match_output_mock.return_value = True
-        output = check_kubectl_namespace(self.namespace)
-        self.assertIsNone(output)
+class IsSelfManagedClusterTest(unittest.TestCase):
+
+    def setUp(self):
+        get_azure_cluster_info.cache_clear()
+        self.addCleanup(get_azure_cluster_info.cache_clear)
+        self.cluster_info_patch = patch('azext_capi.helpers.kubectl.get_azure_cluster_info')
+        self.cluster_info_mock = self.cluster_info_patch.start()
+        self.addCleanup(self.cluster_info_patch.stop)
+        self.current_server_patch = patch('azext_capi.helpers.kubectl.get_current_server')
+        self.current_server_mock = self.current_server_patch.start()
+        self.addCleanup(self.current_server_patch.stop)
+
+    def test_matching_endpoint(self):
+        self.cluster_info_mock.return_value = AzureClusterInfo("fake-rg", "fake-cluster.eastus.cloudapp.azure.com", 6443)
+        self.current_server_mock.return_value = "https://Fake-Cluster.eastus.cloudapp.azure.com:6443"
+        self.assertTrue(is_self_managed_cluster("fake-cluster"))
+
+    def test_default_port(self):
+        self.cluster_info_mock.return_value = AzureClusterInfo("fake-rg", "fake-cluster.eastus.cloudapp.azure.com", 443)
+        self.current_server_mock.return_value = "https://fake-cluster.eastus.cloudapp.azure.com"
+        self.assertTrue(is_self_managed_cluster("fake-cluster"))
+
+    def test_endpoint_not_provisioned(self):
+        self.cluster_info_mock.return_value = AzureClusterInfo("fake-rg", "", None)
+        self.assertFalse(is_self_managed_cluster("fake-cluster"))
+        self.current_server_mock.assert_not_called()
+
+    def test_different_server(self):
+        self.cluster_info_mock.return_value = AzureClusterInfo("fake-rg", "fake-cluster.eastus.cloudapp.azure.com", 6443)
+        self.current_server_mock.return_value = "https://127.0.0.1:6443"
+        self.assertFalse(is_self_managed_cluster("fake-cluster"))
+
+    def test_different_port(self):
+        self.cluster_info_mock.return_value = AzureClusterInfo("fake-rg", "fake-cluster.eastus.cloudapp.azure.com", 6443)
+        self.current_server_mock.return_value = "https://fake-cluster.eastus.cloudapp.azure.com"
+        self.assertFalse(is_self_managed_cluster("fake-cluster"))
+
+    def test_azure_cluster_not_found(self):
+        self.cluster_info_mock.side_effect = InvalidArgumentValueError("Could not find fake-cluster")
+        self.assertFalse(is_self_managed_cluster("fake-cluster"))
+        self.current_server_mock.assert_not_called()
 
 
 class ManagementClusterComponentsMissingMatchExpressionTest(unittest.TestCase):
@@ -381,7 +598,7 @@ class ManagementClusterComponentsMissingMatchExpressionTest(unittest.TestCase):
 
     def test_invalid_mgmt_matches(self):
         for out in self.InvalidCases:
-            self.assertIsNone(management_cluster_components_missing_matching_expressions(out))
+            self.assertFalse(management_cluster_components_missing_matching_expressions(out))
 
 
 class AddKubeconfigFlagMethodTest(unittest.TestCase):
@@ -408,6 +625,15 @@ class HasKindPrefix(unittest.TestCase):
         self.assertFalse(generic.has_kind_prefix(fake_input))
 
 
+class StripKindPrefix(unittest.TestCase):
+
+    def test_valid_prefix(self):
+        self.assertEqual(generic.strip_kind_prefix("kind-fake"), "fake")
+
+    def test_no_prefix(self):
+        self.assertEqual(generic.strip_kind_prefix("fake-kind-"), "fake-kind-")
+
+
 class GetUrlDomainName(unittest.TestCase):
 
     def test_correct_url(self):
@@ -531,6 +757,11 @@ class IsClusterctlCompatible(unittest.TestCase):
         self.assertTrue(generic.is_clusterctl_compatible("testfile.yaml"))
         self.assertTrue(generic.is_clusterctl_compatible("./testfile.yaml"))
 
+    def test_url_skips_local_file_check(self):
+        for out in self.Compatible + self.NotCompatible:
+            generic.is_clusterctl_compatible(out)
+        self.os_path_isfile_mock.assert_not_called()
+
 
 class TestGenerateClusterName(unittest.TestCase):
 
@@ -589,6 +820,65 @@ preferences: {}
                 del os.environ["KUBECONFIG"]
 
 
+class TestWriteToFile(unittest.TestCase):
+
+    def test_keeps_existing_permissions(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filename = os.path.join(temp_dir, "cluster.yaml")
+            with open(filename, "w", encoding="utf-8") as file:
+                file.write("old")
+            os.chmod(filename, 0o640)
+            write_to_file(filename, "new")
+            with open(filename, encoding="utf-8") as file:
+                self.assertEqual(file.read(), "new")
+            self.assertEqual(os.stat(filename).st_mode & 0o777, 0o640)
+            self.assertEqual(os.listdir(temp_dir), ["cluster.yaml"])
+
+
+class TestDiscoveryCache(unittest.TestCase):
+
+    def setUp(self):
+        self.config_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.config_dir.cleanup)
+        self.config_dir_patch = patch('azext_capi.helpers.discovery_cache.get_config_dir')
+        self.config_dir_patch.start().return_value = self.config_dir.name
+        self.addCleanup(self.config_dir_patch.stop)
+
+    def test_miss_then_hit(self):
+        func = Mock(return_value="v1.26.0")
+        self.assertEqual(discovery_cache.cached("fake-key", func), "v1.26.0")
+        self.assertEqual(discovery_cache.cached("fake-key", func), "v1.26.0")
+        func.assert_called_once()
+
+    def test_expired_entry(self):
+        discovery_cache.set_cached("fake-key", "v1.25.0")
+        self.assertEqual(discovery_cache.get_cached("fake-key"), "v1.25.0")
+        self.assertIsNone(discovery_cache.get_cached("fake-key", ttl=-1))
+
+    @patch('azext_capi.helpers.discovery_cache.urlretrieve_if_modified')
+    def test_cached_download_revalidates(self, retrieve_mock):
+        def download(_url, filename, *_validators):
+            with open(filename, "w", encoding="utf-8") as out:
+                out.write("v1")
+            return '"etag-1"', None
+        retrieve_mock.side_effect = download
+        path = discovery_cache.cached_download("https://fake.url/template.yaml")
+        retrieve_mock.side_effect = None
+        retrieve_mock.return_value = None
+        self.assertEqual(discovery_cache.cached_download("https://fake.url/template.yaml"), path)
+        self.assertEqual(retrieve_mock.call_args[0][2:], ('"etag-1"', None))
+        with open(path, encoding="utf-8") as cached_file:
+            self.assertEqual(cached_file.read(), "v1")
+
+    @patch('azext_capi.helpers.discovery_cache.urlretrieve_if_modified')
+    def test_cached_download_failure_leaves_no_partial_file(self, retrieve_mock):
+        retrieve_mock.side_effect = OSError("connection reset")
+        with self.assertRaises(OSError):
+            discovery_cache.cached_download("https://fake.url/template.yaml")
+        cache_dir = os.path.join(self.config_dir.name, "capi", "cache")
+        self.assertEqual(os.listdir(cache_dir), [])
+
+
 class TestGetArch(unittest.TestCase):
 
     def test_get_arch(self):